@@ -0,0 +1,249 @@
+"""
+Offline acuity threshold analysis.
+
+Loads saved sessions (trial logs or the CSVs derived from them),
+fits a psychometric function of letter accuracy against LogMAR for each
+participant and eye, and reports the threshold LogMAR with a bootstrap
+confidence interval.
+
+The fit is a maximum-likelihood grid search: the log-likelihood of every
+(threshold, slope) pair is one matrix product of the correct/incorrect counts
+per LogMAR level with the log probabilities on the grid, so all bootstrap
+replicates of an eye are fitted together. Eyes are fitted in parallel across a
+process pool. Eyes whose symbol_accuracy (the end-of-stream attention check)
+falls below a criterion are reported but excluded from the fit.
+
+Usage:
+    python acuity_analysis.py data --bootstrap 2000 --output thresholds.csv
+"""
+
+import argparse
+import csv
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from stimulus_sizes import FONT_ARCMIN
+from trial_log import read_trial_log
+
+# Chance of guessing the target: one of the 10 target letters
+GUESS_RATE = 0.1
+# Proportion of trials missed at any size (blinks, lapses of attention)
+LAPSE_RATE = 0.02
+
+# Grid searched for the threshold (LogMAR at the midpoint of the function) and slope
+THRESHOLD_GRID = np.arange(-0.6, 1.3 + 1e-9, 0.01)
+SLOPE_GRID = np.geomspace(2.0, 100.0, 40)
+
+# Eyes with a lower end-symbol accuracy are excluded
+MIN_SYMBOL_ACCURACY = 0.8
+
+# Bootstrap replicates fitted per matrix product, to bound memory use
+BOOTSTRAP_CHUNK = 500
+
+
+def degrees_to_logmar(size_deg):
+    """Inverse of stimulus_sizes.logmar_to_degrees()."""
+    return np.log10(np.asarray(size_deg, dtype=float) * FONT_ARCMIN / 5.0)
+
+
+def psychometric(logmar, threshold, slope, guess=GUESS_RATE, lapse=LAPSE_RATE):
+    """Probability of identifying the target at each LogMAR (logistic, rising with size)."""
+    return guess + (1 - guess - lapse) / (1 + np.exp(-slope * (logmar - threshold)))
+
+
+def _eye(block_type):
+    """Eye of a block from its block_type, e.g. 'left_response' -> 'left'."""
+    return block_type.split('_', 1)[0] if '_' in block_type else 'none'
+
+
+def _number(value):
+    """Float of a saved value, or None for 'N/A' and blanks."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _read_session(path):
+    if path.endswith('.jsonl'):
+        return read_trial_log(path)
+    with open(path, newline='', encoding='utf-8') as f:
+        return list(csv.DictReader(f))
+
+
+def find_sessions(paths):
+    """
+    Expand folders into their session files. A session's trial log is used in
+    preference to the CSV derived from it.
+    """
+    sessions = []
+    for path in paths:
+        if not os.path.isdir(path):
+            sessions.append(path)
+            continue
+        logs = glob.glob(os.path.join(path, '*_trials.jsonl'))
+        logged = {log[:-len('_trials.jsonl')] for log in logs}
+        csvs = [f for f in glob.glob(os.path.join(path, '*.csv')) if f[:-len('.csv')] not in logged]
+        sessions.extend(sorted(logs) + sorted(csvs))
+    return sessions
+
+
+def load_trials(paths):
+    """
+    Collect the trials of every session, grouped by participant and eye.
+
+    Returns:
+        dict: (participant, eye) -> dict of NumPy arrays 'logmar' and
+              'correct' for response trials, and 'symbol_correct' for all trials
+    """
+    groups = {}
+    for path in find_sessions(paths):
+        for trial in _read_session(path):
+            block_type = trial.get('block_type') or ''
+            eye = _eye(block_type)
+            if eye not in ('left', 'right'):
+                continue  # Practice trials
+            group = groups.setdefault((str(trial.get('Participant ID', '')), eye),
+                                      {'logmar': [], 'correct': [], 'symbol_correct': []})
+
+            symbol_correct = _number(trial.get('symbol_accuracy'))
+            if symbol_correct is not None:
+                group['symbol_correct'].append(symbol_correct)
+
+            correct = _number(trial.get('letter_accuracy'))
+            if correct is None:
+                continue  # No-response trials
+            logmar = _number(trial.get('logmar'))
+            if logmar is None:
+                logmar = float(degrees_to_logmar(float(trial['stim_size_deg'])))
+            group['logmar'].append(logmar)
+            group['correct'].append(correct)
+
+    return {key: {name: np.array(values) for name, values in group.items()}
+            for key, group in groups.items()}
+
+
+def fit_counts(n_trials, n_correct, levels):
+    """
+    Maximum-likelihood fit for one or more sets of counts on the same levels.
+
+    Args:
+        n_trials (np.ndarray): Trials at each level, shape (K,)
+        n_correct (np.ndarray): Correct trials at each level, shape (B, K)
+        levels (np.ndarray): LogMAR of each level, shape (K,)
+
+    Returns:
+        tuple: (thresholds, slopes), each of shape (B,)
+    """
+    thresholds, slopes = np.meshgrid(THRESHOLD_GRID, SLOPE_GRID, indexing='ij')
+    thresholds, slopes = thresholds.ravel(), slopes.ravel()
+    p = psychometric(levels[None, :], thresholds[:, None], slopes[:, None])
+    log_p, log_q = np.log(p), np.log1p(-p)
+
+    n_correct = np.atleast_2d(n_correct)
+    best = np.empty(len(n_correct), dtype=int)
+    for start in range(0, len(n_correct), BOOTSTRAP_CHUNK):
+        correct = n_correct[start:start + BOOTSTRAP_CHUNK]
+        log_likelihood = correct @ log_p.T + (n_trials - correct) @ log_q.T
+        best[start:start + BOOTSTRAP_CHUNK] = np.argmax(log_likelihood, axis=1)
+    return thresholds[best], slopes[best]
+
+
+def fit_eye(job):
+    """
+    Fit one participant's eye and bootstrap its threshold.
+
+    Args:
+        job (tuple): ((participant, eye), trials from load_trials(),
+                      n_bootstrap, ci, min_symbol_accuracy, seed)
+
+    Returns:
+        dict: The fit, its confidence interval and the exclusion decision
+    """
+    (participant, eye), trials, n_bootstrap, ci, min_symbol_accuracy, seed = job
+    symbol_accuracy = float(np.mean(trials['symbol_correct'])) if len(trials['symbol_correct']) else float('nan')
+    result = {
+        'participant': participant,
+        'eye': eye,
+        'n_trials': len(trials['correct']),
+        'symbol_accuracy': symbol_accuracy,
+        'excluded': not symbol_accuracy >= min_symbol_accuracy,
+        'threshold_logmar': float('nan'),
+        'slope': float('nan'),
+        'ci_low': float('nan'),
+        'ci_high': float('nan'),
+    }
+    if result['excluded'] or not len(trials['correct']):
+        return result
+
+    levels, level_index = np.unique(trials['logmar'], return_inverse=True)
+    n_trials = np.bincount(level_index, minlength=len(levels))
+    n_correct = np.bincount(level_index, weights=trials['correct'], minlength=len(levels))
+    threshold, slope = fit_counts(n_trials, n_correct, levels)
+    result['threshold_logmar'] = float(threshold[0])
+    result['slope'] = float(slope[0])
+
+    if n_bootstrap:
+        # Resampling trials within each level is binomial resampling of its counts
+        rng = np.random.default_rng(seed)
+        resampled = rng.binomial(n_trials, n_correct / n_trials, size=(n_bootstrap, len(levels)))
+        boot_thresholds, _ = fit_counts(n_trials, resampled, levels)
+        tail = (100 - ci) / 2
+        result['ci_low'], result['ci_high'] = np.percentile(boot_thresholds, [tail, 100 - tail]).tolist()
+    return result
+
+
+def analyse(paths, n_bootstrap=2000, ci=95, min_symbol_accuracy=MIN_SYMBOL_ACCURACY, workers=None, seed=0):
+    """
+    Fit every participant and eye found in paths.
+
+    Args:
+        paths (list): Session files or folders of them
+        n_bootstrap (int): Bootstrap replicates per eye (0 to skip)
+        ci (float): Width of the confidence interval in percent
+        min_symbol_accuracy (float): Exclusion criterion on symbol_accuracy
+        workers (int): Processes in the pool (default: one per CPU)
+        seed (int): Seed for the bootstrap
+
+    Returns:
+        list: One result dict per participant and eye, see fit_eye()
+    """
+    groups = load_trials(paths)
+    keys = sorted(groups)
+    seeds = np.random.SeedSequence(seed).spawn(len(keys))
+    jobs = [(key, groups[key], n_bootstrap, ci, min_symbol_accuracy, s) for key, s in zip(keys, seeds)]
+    if workers == 1 or len(jobs) <= 1:
+        return [fit_eye(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(fit_eye, jobs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help="Session files (.jsonl or .csv) or folders of them")
+    parser.add_argument('--bootstrap', type=int, default=2000, help="Bootstrap replicates per eye")
+    parser.add_argument('--ci', type=float, default=95, help="Confidence interval width in percent")
+    parser.add_argument('--min-symbol-accuracy', type=float, default=MIN_SYMBOL_ACCURACY,
+                        help="Exclude eyes with a lower end-symbol accuracy")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: one per CPU)")
+    parser.add_argument('--seed', type=int, default=0, help="Bootstrap seed")
+    parser.add_argument('--output', help="CSV file to write the results to")
+    args = parser.parse_args()
+
+    results = analyse(args.paths, args.bootstrap, args.ci, args.min_symbol_accuracy, args.workers, args.seed)
+    for r in results:
+        status = "EXCLUDED" if r['excluded'] else f"{r['threshold_logmar']:6.3f} [{r['ci_low']:6.3f}, {r['ci_high']:6.3f}]"
+        print(f"{r['participant']:>12} {r['eye']:>5}  n={r['n_trials']:<4} symbols={r['symbol_accuracy']:.2f}  {status}")
+
+    if args.output and results:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+
+
+if __name__ == '__main__':
+    main()
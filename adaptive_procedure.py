@@ -0,0 +1,151 @@
+"""
+Bayesian adaptive staircase (QUEST+) over the LogMAR levels of a block.
+
+Instead of showing every LogMAR level a fixed number of times, the staircase
+keeps a posterior over the psychometric function's threshold, slope and lapse
+rate. On each trial it shows the level that is expected to reduce the
+posterior's entropy the most, and it stops once the threshold is known
+precisely enough. It uses the psychometric function of acuity_analysis, so the
+thresholds it converges on match the offline fits.
+
+The probability of a correct answer for every parameter combination at every
+level is computed once into a LikelihoodTable and cached on disk, keyed by the
+grids, the levels and the conditions file. Choosing a level is then two
+matrix-vector products and an update is one multiplication.
+"""
+
+import hashlib
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from acuity_analysis import psychometric, THRESHOLD_GRID, GUESS_RATE
+
+# Parameter grids of the posterior (threshold uses the analysis grid)
+SLOPE_GRID = np.geomspace(3.0, 60.0, 12)
+LAPSE_GRID = np.array([0.0, 0.02, 0.05])
+
+# Bump whenever the table layout or model changes, so old cache files are ignored
+TABLE_VERSION = 1
+
+# levels: sorted LogMAR levels (K,)
+# thresholds, slopes, lapses: parameter of each grid point (P,), threshold-major
+# p_correct: probability of a correct answer for each level and grid point (K, P)
+# neg_entropy: p log p + (1 - p) log(1 - p) of p_correct (K, P)
+LikelihoodTable = namedtuple('LikelihoodTable', ['levels', 'thresholds', 'slopes', 'lapses',
+                                                 'p_correct', 'neg_entropy'])
+
+
+def file_hash(path):
+    """SHA-256 of a file's contents."""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _table_key(levels, conditions_hash):
+    key = hashlib.sha256()
+    for array in (np.asarray(levels, dtype=float), THRESHOLD_GRID, SLOPE_GRID, LAPSE_GRID,
+                  np.array([GUESS_RATE, TABLE_VERSION], dtype=float)):
+        key.update(np.ascontiguousarray(array).tobytes())
+    key.update(conditions_hash.encode())
+    return key.hexdigest()[:16]
+
+
+def compute_likelihood_table(levels):
+    """Evaluate the psychometric function for every level and grid point."""
+    levels = np.sort(np.asarray(levels, dtype=float))
+    thresholds, slopes, lapses = (grid.ravel() for grid in
+                                  np.meshgrid(THRESHOLD_GRID, SLOPE_GRID, LAPSE_GRID, indexing='ij'))
+    # Keep log(p) and log(1 - p) finite where there is no lapse
+    p_correct = np.clip(psychometric(levels[:, None], thresholds, slopes, lapse=lapses), 1e-12, 1 - 1e-12)
+    neg_entropy = p_correct * np.log(p_correct) + (1 - p_correct) * np.log1p(-p_correct)
+    return LikelihoodTable(levels, thresholds, slopes, lapses, p_correct, neg_entropy)
+
+
+def load_likelihood_table(levels, cache_dir, conditions_hash=''):
+    """
+    Load the likelihood table for levels from cache_dir, computing and saving
+    it first if no table was cached for the same grids, levels and conditions.
+
+    Args:
+        levels (list): LogMAR levels that can be shown
+        cache_dir (str): Folder for cached tables
+        conditions_hash (str): Hash of the conditions file, see file_hash()
+
+    Returns:
+        LikelihoodTable: The table
+    """
+    path = os.path.join(cache_dir, f"likelihood_{_table_key(levels, conditions_hash)}.npz")
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            return LikelihoodTable(**{field: cached[field] for field in LikelihoodTable._fields})
+
+    table = compute_likelihood_table(levels)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(path, **table._asdict())
+    return table
+
+
+class BayesianStaircase:
+    """
+    QUEST+ staircase restricted to a fixed set of LogMAR levels.
+
+    Args:
+        levels (list): LogMAR levels that can be shown
+        table (LikelihoodTable): Precomputed table for levels (default: computed here)
+        prior_mean (float): Prior threshold (default: middle of the levels)
+        prior_sd (float): Prior standard deviation of the threshold
+        max_sd (float): Stop once the posterior SD of the threshold is this small
+        min_trials (int): Never stop before this many trials
+        max_trials (int): Always stop after this many trials
+    """
+
+    def __init__(self, levels, table=None, prior_mean=None, prior_sd=0.5,
+                 max_sd=0.05, min_trials=10, max_trials=40):
+        self.table = table if table is not None else compute_likelihood_table(levels)
+        self.levels = self.table.levels
+        self.max_sd = max_sd
+        self.min_trials = min_trials
+        self.max_trials = max_trials
+        if prior_mean is None:
+            prior_mean = (self.levels[0] + self.levels[-1]) / 2
+        # Normal prior on the threshold, flat over slopes and lapse rates
+        self.posterior = np.exp(-0.5 * ((self.table.thresholds - prior_mean) / prior_sd) ** 2)
+        self.posterior /= self.posterior.sum()
+        self.history = []  # (level, correct) of every trial so far
+
+    def threshold_marginal(self):
+        """Posterior over THRESHOLD_GRID."""
+        return self.posterior.reshape(len(THRESHOLD_GRID), -1).sum(axis=1)
+
+    def mean(self):
+        return float(self.threshold_marginal() @ THRESHOLD_GRID)
+
+    def sd(self):
+        p = self.threshold_marginal()
+        mean = p @ THRESHOLD_GRID
+        return float(np.sqrt(p @ (THRESHOLD_GRID - mean) ** 2))
+
+    def next_level(self):
+        """
+        LogMAR level to show next: the one with the lowest expected posterior
+        entropy, i.e. the most informative about the parameters.
+        """
+        # Expected posterior entropy of each level, up to a constant shared by
+        # all levels: E[h(p)] over the posterior minus h(E[p]), h = binary entropy
+        p_correct = np.clip(self.table.p_correct @ self.posterior, 1e-12, 1 - 1e-12)
+        outcome_entropy = p_correct * np.log(p_correct) + (1 - p_correct) * np.log1p(-p_correct)
+        expected_entropy = outcome_entropy - self.table.neg_entropy @ self.posterior
+        return float(self.levels[np.argmin(expected_entropy)])
+
+    def update(self, level, correct):
+        """Add the outcome of a trial shown at level."""
+        row = self.table.p_correct[np.argmin(np.abs(self.levels - level))]
+        self.posterior *= row if correct else 1 - row
+        self.posterior /= self.posterior.sum()
+        self.history.append((level, bool(correct)))
+
+    def finished(self):
+        n = len(self.history)
+        return n >= self.max_trials or (n >= self.min_trials and self.sd() <= self.max_sd)
@@ -0,0 +1,240 @@
+"""
+Continuous acquisition of U3 analog inputs in stream mode.
+
+AnalogStream configures a U3 stream over a few AIN channels and reads it on
+its own thread with U3.streamData(). Each block is decoded with
+processStreamData() and copied into a preallocated NumPy ring buffer of
+(timestamp, values) rows, so the last buffer_seconds of every channel can be
+read back at any time with get_samples(start, end). That call never waits for
+the device: it returns whatever has been acquired for the interval so far.
+
+The U3 clocks the scans itself, so scan k was taken at k / scan_frequency
+after the stream started. Timestamps are put on the experiment's clock by
+comparing the scan count with the time each block arrived: a block can only
+arrive after its last scan, so the smallest (arrival - scan time) over recent
+blocks is the offset between the two clocks, with USB latency removed. Using
+recent blocks only lets the offset follow drift between the U3's oscillator
+and the host clock.
+
+Every packet carries a counter. A gap in the counter means packets were lost
+on the way to the host; an auto-recovery packet (error 60) means the U3's own
+buffer overflowed and reports how many scans it skipped. Both advance the
+scan count, so the timestamps of later scans stay right, and are counted in
+status() along with the device's buffer backlog. Requests for samples that
+have already been overwritten in the ring buffer are counted as overruns.
+
+The U3 keeps answering feedback commands while it streams, so the stream can
+share the device with labjackU3's trigger dispatcher.
+"""
+
+import collections
+import threading
+from time import perf_counter
+
+import numpy as np
+
+# Header and footer bytes of a stream packet, around the 2-byte samples
+PACKET_HEADER = 12
+PACKET_FOOTER = 2
+
+# Error code of the packet that ends an auto-recovery, bytes 6-9 hold the skipped scans
+AUTO_RECOVERY_END = 60
+
+# Number of recent blocks the clock offset is estimated from
+OFFSET_WINDOW = 50
+
+# times: timestamp of each scan on the stream's clock (n,)
+# values: volts of each channel at each scan (n, channels)
+# complete: False if part of the interval was overwritten or not acquired yet
+StreamWindow = collections.namedtuple('StreamWindow', ['times', 'values', 'complete'])
+
+
+class AnalogStream:
+    """
+    Background stream of U3 analog inputs into a ring buffer.
+
+    Args:
+        device (u3.U3): Open U3, e.g. labjackU3.u3card
+        channels (list): Positive AIN channels to stream, read single-ended
+        scan_frequency (float): Scans per second (each scan reads every channel)
+        buffer_seconds (float): Length of the ring buffer
+        read_interval (float): Approximate time covered by one read from the device
+        clock (callable): Clock for the timestamps, e.g. core.monotonicClock.getTime
+    """
+
+    def __init__(self, device, channels, scan_frequency, buffer_seconds=60.0,
+                 read_interval=0.02, clock=perf_counter):
+        self.device = device
+        self.channels = list(channels)
+        self.scan_frequency = float(scan_frequency)
+        self.read_interval = read_interval
+        self.clock = clock
+
+        capacity = int(np.ceil(buffer_seconds * self.scan_frequency))
+        self.times = np.empty(capacity)
+        self.values = np.empty((capacity, len(self.channels)))
+        self.written = 0    # Scans written to the ring buffer
+        self.lock = threading.Lock()
+
+        self.scans = 0      # Scans taken by the device, including lost ones
+        self.lost_packets = 0
+        self.skipped_scans = 0
+        self.max_backlog = 0
+        self.overruns = 0
+        self.error = None
+        self._recent_offsets = collections.deque(maxlen=OFFSET_WINDOW)
+        self._last_counter = None
+        self._stop = threading.Event()
+        self._reader = None
+
+    def start(self):
+        """Configure the channels as analog inputs, start the stream and the reader thread."""
+        device = self.device
+        if device.calData is None:
+            device.getCalibrationData()
+        device.configAnalog(*[channel for channel in self.channels if channel < 16])
+
+        # Whole scans per packet, so every block holds whole scans
+        samples_per_packet = 25 - 25 % len(self.channels)
+        device.streamConfig(NumChannels=len(self.channels), PChannels=self.channels,
+                            NChannels=[31] * len(self.channels), Resolution=3,
+                            SamplesPerPacket=samples_per_packet, ScanFrequency=self.scan_frequency)
+        self.scans_per_packet = samples_per_packet // len(self.channels)
+        # Read little and often instead of up to 48 packets at a time
+        device.packetsPerRequest = max(1, min(48, int(round(
+            self.read_interval * self.scan_frequency / self.scans_per_packet))))
+
+        device.streamStart()
+        self._recent_offsets.append(self.clock())
+        self._stop.clear()
+        self._reader = threading.Thread(target=self._read_worker, name="analog-stream-reader", daemon=True)
+        self._reader.start()
+
+    def stop(self):
+        """Stop the reader thread and the stream."""
+        if self._reader is not None:
+            self._stop.set()
+            self._reader.join()
+        self._reader = None
+
+    def _read_worker(self):
+        try:
+            for block in self.device.streamData(convert=False):
+                if self._stop.is_set():
+                    break
+                if block is None:
+                    continue
+                self._add_block(block['result'], self.clock())
+        except Exception as e:
+            self.error = e
+        finally:
+            try:
+                self.device.streamStop()
+            except Exception as e:
+                self.error = self.error or e
+
+    def _add_block(self, result, arrival):
+        """Check the packets of a block read at arrival and add its scans."""
+        packet_bytes = PACKET_HEADER + 2 * self.scans_per_packet * len(self.channels) + PACKET_FOOTER
+        packets = np.frombuffer(result, dtype=np.uint8)
+        packets = packets[:len(packets) // packet_bytes * packet_bytes].reshape(-1, packet_bytes)
+        if not len(packets):
+            return
+
+        # Packets lost between the device and here
+        counters = packets[:, 10].astype(int)
+        expected_first = counters[0] if self._last_counter is None else (self._last_counter + 1) % 256
+        gaps = np.diff(np.concatenate(([expected_first - 1], counters))) % 256 - 1
+        self._last_counter = counters[-1]
+
+        # Scans the device skipped while recovering from a full buffer
+        recovered = packets[:, 11] == AUTO_RECOVERY_END
+        skipped = packets[recovered, 6:10].copy().view('<u4').ravel()
+
+        self.max_backlog = max(self.max_backlog, int(packets[:, -PACKET_FOOTER].max()))
+        self.lost_packets += int(gaps.sum())
+        self.skipped_scans += int(skipped.sum())
+
+        channels = self.device.processStreamData(result, numBytes=packet_bytes)
+        values = np.column_stack([channels["AIN%s" % channel] for channel in self.channels])
+
+        # Scan index of every row: each packet follows the lost packets and
+        # skipped scans before it
+        skipped_before = np.zeros(len(packets), dtype=np.int64)
+        skipped_before[recovered] = skipped
+        packet_start = ((np.arange(len(packets)) + np.cumsum(gaps)) * self.scans_per_packet
+                        + np.cumsum(skipped_before))
+        scan_index = self.scans + (packet_start[:, None] + np.arange(self.scans_per_packet)).ravel()
+        self.scans = int(scan_index[-1]) + 1
+
+        # The last scan was taken before the block arrived
+        self._recent_offsets.append(arrival - self.scans / self.scan_frequency)
+        times = scan_index / self.scan_frequency + min(self._recent_offsets)
+        self._write(times, values)
+
+    def _write(self, times, values):
+        capacity = len(self.times)
+        times, values = times[-capacity:], values[-capacity:]
+        with self.lock:
+            start = self.written % capacity
+            first = min(len(times), capacity - start)
+            self.times[start:start + first] = times[:first]
+            self.values[start:start + first] = values[:first]
+            self.times[:len(times) - first] = times[first:]
+            self.values[:len(times) - first] = values[first:]
+            self.written += len(times)
+
+    def _segments(self):
+        """Slices of the ring buffer holding the written scans, oldest first."""
+        capacity = len(self.times)
+        if self.written <= capacity:
+            return [slice(0, self.written)]
+        split = self.written % capacity
+        return [slice(split, capacity), slice(0, split)]
+
+    def get_samples(self, start, end):
+        """
+        Scans with start <= timestamp < end that are in the buffer now.
+
+        Args:
+            start (float): Start of the interval on the stream's clock
+            end (float): End of the interval
+
+        Returns:
+            StreamWindow: Copies of the scans' timestamps and values
+        """
+        times, values = [], []
+        with self.lock:
+            segments = self._segments()
+            oldest = self.times[segments[0].start] if self.written else np.inf
+            newest = self.times[(self.written - 1) % len(self.times)] if self.written else -np.inf
+            for segment in segments:
+                segment_times = self.times[segment]
+                first, last = np.searchsorted(segment_times, (start, end))
+                times.append(segment_times[first:last].copy())
+                values.append(self.values[segment][first:last].copy())
+
+        overwritten = start < oldest and self.written > len(self.times)
+        if overwritten:
+            self.overruns += 1
+        complete = not overwritten and newest >= end - 1 / self.scan_frequency
+        return StreamWindow(np.concatenate(times), np.concatenate(values), complete)
+
+    def latest_time(self):
+        """Timestamp of the newest scan in the buffer, or None before the first block."""
+        with self.lock:
+            if not self.written:
+                return None
+            return float(self.times[(self.written - 1) % len(self.times)])
+
+    def status(self):
+        """Counters for checking the stream: see the module docstring."""
+        return {
+            'running': self._reader is not None and self._reader.is_alive(),
+            'scans': self.scans,
+            'lost_packets': self.lost_packets,
+            'skipped_scans': self.skipped_scans,
+            'max_backlog': self.max_backlog,
+            'overruns': self.overruns,
+            'error': None if self.error is None else str(self.error),
+        }
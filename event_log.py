@@ -0,0 +1,61 @@
+"""
+Structured per-trial event buffer.
+
+Stream events (stream start, triggered items, stream end) are recorded into a
+preallocated record array while the stream is running: recording one is a
+single row assignment, with no string formatting and no call into PsychoPy's
+logging. Once the stream is over the events are stamped with their flip times
+and written to the log in one go.
+"""
+
+import numpy as np
+
+EVENT_LOG_DTYPE = np.dtype([
+    ('timestamp', 'f8'),    # Flip the event was shown on (NaN until stamp())
+    ('frame', 'i4'),        # Index of that flip in the trial's flip times
+    ('event', 'u1'),        # Index into EventBuffer.labels
+    ('item', 'U1'),         # Symbol shown, '' if none
+    ('trigger', 'u1'),      # Trigger value sent with the event, 0 if none
+])
+
+
+class EventBuffer:
+    """
+    Preallocated buffer of EVENT_LOG_DTYPE records for one trial.
+
+    Args:
+        labels (list): Log label of each event type, indexed by the event field
+        capacity (int): Maximum number of events per trial
+    """
+
+    def __init__(self, labels, capacity=32):
+        self.labels = list(labels)
+        self.records = np.zeros(capacity, dtype=EVENT_LOG_DTYPE)
+        self.count = 0
+
+    def clear(self):
+        self.count = 0
+
+    def record(self, frame, event, item='', trigger=0):
+        """Add an event shown on the given frame."""
+        self.records[self.count] = (np.nan, frame, event, item, trigger)
+        self.count += 1
+
+    def stamp(self, flip_times):
+        """Fill in every event's timestamp from the trial's flip times."""
+        events = self.records[:self.count]
+        events['timestamp'] = np.asarray(flip_times)[events['frame']]
+
+    def entries(self):
+        """Copy of the events since the last clear()."""
+        return self.records[:self.count].copy()
+
+    def dump(self, log_function):
+        """
+        Pass one line per event to log_function (e.g. logging.exp), timestamped
+        with the event's flip, then clear the buffer. Call after the stream.
+        """
+        for entry in self.records[:self.count]:
+            log_function(f"{self.labels[entry['event']]} - Item: {entry['item']}, Trigger: {entry['trigger']}",
+                         t=float(entry['timestamp']))
+        self.clear()
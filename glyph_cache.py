@@ -0,0 +1,78 @@
+"""
+Pre-rendered glyph cache for the RSVP stream.
+
+TextStim.setText() re-lays out the string and re-uploads the glyph texture
+every time it is called, which is too slow to do between two flips on a 4K
+display. GlyphCache keeps one TextStim per (symbol, height) pair instead, so
+the layout and texture upload happen once and an item onset only has to pick
+which stimulus to draw.
+"""
+
+from collections import OrderedDict
+
+from psychopy import visual
+
+
+class GlyphCache:
+    """
+    Cache of TextStims keyed by (symbol, height).
+
+    Args:
+        win (visual.Window): Window the stimuli are drawn in
+        font (str): Font used for every glyph
+        max_items (int): Maximum number of glyphs to keep. When the cache is
+            full the least recently used glyph is dropped. None keeps every
+            glyph that has been rendered.
+        **stim_kwargs: Extra keyword arguments passed on to visual.TextStim
+    """
+
+    def __init__(self, win, font, max_items=None, **stim_kwargs):
+        self.win = win
+        self.font = font
+        self.max_items = max_items
+        self.stim_kwargs = stim_kwargs
+        self._glyphs = OrderedDict()
+
+    def __len__(self):
+        return len(self._glyphs)
+
+    def __contains__(self, key):
+        return key in self._glyphs
+
+    def _render(self, symbol, height):
+        """Create the TextStim for a glyph and force its texture upload."""
+        stim = visual.TextStim(win=self.win, text=symbol, height=height,
+                               font=self.font, **self.stim_kwargs)
+        # Drawing once to the back buffer builds the glyph texture now rather
+        # than on the first frame the item is shown.
+        stim.draw()
+        return stim
+
+    def get(self, symbol, height):
+        """
+        Return the TextStim for a symbol at a given height, rendering it if
+        it has not been cached yet.
+        """
+        key = (symbol, height)
+        stim = self._glyphs.get(key)
+        if stim is None:
+            stim = self._render(symbol, height)
+            self._glyphs[key] = stim
+            if self.max_items is not None and len(self._glyphs) > self.max_items:
+                self._glyphs.popitem(last=False)
+        elif self.max_items is not None:
+            self._glyphs.move_to_end(key)
+        return stim
+
+    def prerender(self, symbols, heights):
+        """
+        Render every symbol at every height up front.
+
+        The back buffer is cleared afterwards so none of the glyphs drawn
+        while rendering reach the screen.
+        """
+        for height in heights:
+            for symbol in symbols:
+                self.get(symbol, height)
+        self.win.clearBuffer()
+        return len(self._glyphs)
@@ -5,7 +5,33 @@
 Functions to execute triggers using LabJack U3 card.
 
 Before using triggers, you need to configure board: configure().
-You can send trigger using trigger(value,duration) function.
+You can send trigger using trigger(value) function and release the
+board with close() when you are done.
+
+Triggers are sent by a single dispatcher thread started by configure().
+trigger() only puts a (value, onset, duration) job on its queue, so it
+returns straight away.
+
+With PULSE_MODE on (the default) the dispatcher sends each trigger as one
+feedback packet: PortStateWrite(value), WaitLong/WaitShort for the
+duration and PortStateWrite(0). The U3 times the pulse width itself, so it
+costs a single USB round trip and is free of OS scheduler jitter. The next
+trigger is sent once the card has finished the pulse.
+
+With PULSE_MODE off the dispatcher writes the value at its onset and
+schedules the clear (signal 0) once the duration has passed. A trigger
+that arrives before the previous one was cleared replaces it and moves
+the clear, so a clear never cuts a later trigger short.
+
+The packets are prepared once (u3.U3.prepareFeedback) when the dispatcher
+starts: one PortStateWrite packet, and one pulse packet per duration used.
+Sending a trigger only patches the FIO state byte (and the checksums) of
+the prepared packet before handing it to the driver.
+
+Every trigger is recorded in trigger_log with the time it was requested,
+the flip it belongs to (if given) and when the USB write started and
+returned, all read from clock(). Set clock to the experiment's clock
+before configure() so these line up with flip timestamps.
 
 --- TECHNICAL INFO ---
 
@@ -21,59 +47,206 @@ version 20160212
 
 import u3
 from LabJackPython import LabJackException
-from time import sleep
+from time import sleep, perf_counter
+import queue
 import threading
+from trigger_log import TriggerLog
 
 #trigger duration (time before sending signal 0)
 DURATION = 0.05
 
+#time the pulse width on the card (one packet per trigger) instead of in Python
+PULSE_MODE = True
+
+#length of one WaitShort / WaitLong increment in microseconds (U3C; U3B WaitShort is 64)
+WAIT_SHORT_US = 128
+WAIT_LONG_US = 16384
+
+#clock used for onsets and for the timestamps in trigger_log
+clock = perf_counter
+
+#timestamps of recent triggers
+trigger_log = TriggerLog()
+
 #u3card is setted during calibration (if you use trigger without calibration there will be exception!)
 u3card = None
 
+#queue of (value, onset, duration, log slot) jobs for the dispatcher thread, None stops it
+_jobs = None
+_dispatcher = None
+
+#prepared PortStateWrite packet and pulse packets by duration, used by the dispatcher thread only
+_port_write = None
+_pulses = {}
+
 
 def configure():
     """Configures LabJack U3 to use FIO ports as Digital Output.
-       Sets signal 0 on card.
+       Sets signal 0 on card and starts the trigger dispatcher.
        Returns 0 if everything is OK"""
-    
+
     global u3card
     u3card = u3.U3()
     u3card.configU3(FIOAnalog = 0, FIODirection = 255, FIOState = 0)
     u3card.configIO()
     u3card.getFeedback( u3.PortStateWrite(State = [0, 0x00, 0x00], WriteMask = [0xff, 0x00, 0x00] ) )
+
+    start_dispatcher()
     return 0
-  
 
-def clear_trigger_worker(value):
-    """Clears trigger. This function is started by trigger()"""
-  
-    global u3card
-    sleep(DURATION)
-    u3card.getFeedback( u3.PortStateWrite(State = [0, 0x00, 0x00], WriteMask = [0xff, 0x00, 0x00] ) )
 
+def start_dispatcher():
+    """Starts the trigger dispatcher thread for u3card.
+       This function is started by configure()"""
 
+    global _jobs, _dispatcher, _port_write, _pulses
+    _port_write = u3card.prepareFeedback( u3.PortStateWrite(State = [0, 0x00, 0x00], WriteMask = [0xff, 0x00, 0x00] ) )
+    _pulses = {}
+    _jobs = queue.SimpleQueue()
+    _dispatcher = threading.Thread(target=dispatch_worker, name="labjackU3-dispatcher", daemon=True)
+    _dispatcher.start()
 
-def trigger(value):
-    """Sends a trigger. Parameters:
-       value: 1-255"""
 
-    global u3card
+def close():
+    """Stops the dispatcher once every queued trigger has been sent
+       and cleared, leaving signal 0 on card."""
+
+    global _jobs, _dispatcher
+    if _dispatcher is not None:
+        _jobs.put(None)
+        _dispatcher.join()
+    _jobs = None
+    _dispatcher = None
+
+
+def write_port(value):
+    """Writes value to the FIO port. Called from the dispatcher thread only."""
+
+    '''PortStateWrite sets three bytes: FIO, EIO, CIO -- we only use the first one and ignore EIO and CIO'''
+    try:
+        _port_write.setByte(fio_state_byte(_port_write, 0), value)
+        _port_write.send()
+    except LabJackException as _:
+        print("LABJACK ERROR. Trigger " + str(value) + " was not sent!")
+
+
+def pulse_commands(value, duration):
+    """Builds the feedback commands for one pulse: value on FIO,
+       a hardware wait of duration seconds, then 0 on FIO."""
+
+    wait_us = int(round(duration * 1e6))
+    long_ticks, wait_us = divmod(wait_us, WAIT_LONG_US)
+    short_ticks = int(round(wait_us / WAIT_SHORT_US))
+
+    commands = [ u3.PortStateWrite(State = [value, 0x00, 0x00], WriteMask = [0xff, 0x00, 0x00] ) ]
+    #each wait command holds at most 255 increments
+    while long_ticks > 0:
+        commands.append( u3.WaitLong(min(long_ticks, 255)) )
+        long_ticks -= 255
+    while short_ticks > 0:
+        commands.append( u3.WaitShort(min(short_ticks, 255)) )
+        short_ticks -= 255
+    commands.append( u3.PortStateWrite(State = [0, 0x00, 0x00], WriteMask = [0xff, 0x00, 0x00] ) )
+    return commands
+
+
+def fio_state_byte(prepared, command):
+    """Index of the FIO state byte of a prepared PortStateWrite command
+       (command id, 3 mask bytes, then FIO, EIO, CIO states)."""
+
+    return prepared.commandOffsets[command] + 4
+
+
+def send_pulse(value, duration):
+    """Sends a whole pulse in one prepared feedback packet. Called from the dispatcher thread only.
+       The call returns once the card has finished the pulse."""
+
+    try:
+        pulse = _pulses.get(duration)
+        if pulse is None:
+            #the packet for a new duration is built once and reused for every value
+            pulse = _pulses[duration] = u3card.prepareFeedback( pulse_commands(0, duration) )
+        pulse.setByte(fio_state_byte(pulse, 0), value)
+        pulse.send()
+    except LabJackException as _:
+        print("LABJACK ERROR. Trigger " + str(value) + " was not sent!")
+
+
+def wait_until(deadline):
+    """Sleeps until clock() reaches deadline."""
+
+    delay = deadline - clock()
+    if delay > 0:
+        sleep(delay)
+
+
+def dispatch_worker():
+    """Sends queued triggers, either as whole pulses (PULSE_MODE) or by
+       clearing each one when its duration is over.
+       This function is started by configure()"""
+
+    clear_at = None
+    while True:
+        timeout = None if clear_at is None else max(0.0, clear_at - clock())
+        try:
+            job = _jobs.get(timeout = timeout)
+        except queue.Empty:
+            #no new trigger arrived before the pending clear was due
+            write_port(0)
+            clear_at = None
+            continue
+
+        if job is None:
+            break
+
+        value, onset, duration, slot = job
+        if PULSE_MODE:
+            wait_until(onset)
+            trigger_log.mark(slot, 'sent', clock())
+            send_pulse(value, duration)
+            trigger_log.mark(slot, 'completed', clock())
+            continue
+
+        if clear_at is not None and clear_at <= onset:
+            wait_until(clear_at)
+            write_port(0)
+            clear_at = None
+        wait_until(onset)
+        trigger_log.mark(slot, 'sent', clock())
+        write_port(value)
+        trigger_log.mark(slot, 'completed', clock())
+        clear_at = clock() + duration
+
+    if clear_at is not None:
+        wait_until(clear_at)
+        write_port(0)
+
+
+def trigger(value, onset = None, duration = None, flip_time = float('nan')):
+    """Queues a trigger for the dispatcher. Parameters:
+       value: 1-255
+       onset: clock() time to send it at (default: now)
+       duration: seconds before signal 0 is sent (default: DURATION)
+       flip_time: timestamp of the flip this trigger marks, for trigger_log
+       Returns 0 if the trigger was queued"""
+
     value = int(value)
-  
+
     #check input:
     error = 0
     if value<=0 or value > 255 :
         error = 1001
+    if _jobs is None :
+        error = 1002
     if error != 0 :
         return error
 
-    #send trigger:
-    '''PortStateWrite sets three bytes: FIO, EIO, CIO -- we only use the first one and ignore EIO and CIO'''
-    try:
-        u3card.getFeedback( u3.PortStateWrite(State = [value, 0x00, 0x00], WriteMask = [0xff, 0x00, 0x00] ) )
-    except LabJackException as _:
-        print("LABJACK ERROR. Trigger " + str(value) + " was not sent!")
-
-    t = threading.Thread(target=clear_trigger_worker, args=(value,))
-    t.start()
-
+    #queue trigger:
+    now = clock()
+    if onset is None:
+        onset = now
+    if duration is None:
+        duration = DURATION
+    slot = trigger_log.add(value, now, flip_time)
+    _jobs.put( (value, onset, duration, slot) )
+    return 0
@@ -0,0 +1,149 @@
+"""
+Photodiode onset detection and trigger-to-photon latency.
+
+The photodiode patch is white on the first frame of every stream item. Its
+trace, read back from analog_stream, is turned into onsets with a hysteresis
+threshold: the patch switches on when the signal rises above the high level
+and can only switch on again once it has fallen below the low level, so
+noise around a single threshold cannot produce extra onsets. The levels are
+set between the trial's dark baseline and the flash peak, so they follow the
+monitor's brightness and the sensor's gain. Each onset is timed where the
+signal crosses the high level, interpolated between samples.
+
+Each item onset flip is then matched with the first detected onset after it,
+and each triggered item with the trigger sent on that flip. That gives the
+flip-to-photon latency of every item and, for triggered items, the time
+from the start of the trigger's USB write to the photons.
+"""
+
+import numpy as np
+
+# Hysteresis levels as fractions of the way from the dark baseline to the flash peak
+HIGH_FRACTION = 0.6
+LOW_FRACTION = 0.4
+
+# A trace that swings less than this (volts) has no flashes in it
+MIN_SWING = 0.05
+
+# Percentiles of the trace taken as the dark baseline and the flash peak
+BASELINE_PERCENTILE = 5
+PEAK_PERCENTILE = 99.5
+
+# Photons can be seen slightly before the flip timestamp, which is taken once
+# the swap has returned; onsets this much earlier still count
+EARLY_TOLERANCE = 0.001
+
+
+def hysteresis_levels(volts, high_fraction=HIGH_FRACTION, low_fraction=LOW_FRACTION, min_swing=MIN_SWING):
+    """
+    High and low levels for a trace, or None if it swings less than min_swing.
+    """
+    if not len(volts):
+        return None
+    baseline, peak = np.percentile(volts, [BASELINE_PERCENTILE, PEAK_PERCENTILE])
+    if peak - baseline < min_swing:
+        return None
+    return baseline + high_fraction * (peak - baseline), baseline + low_fraction * (peak - baseline)
+
+
+def detect_onsets(times, volts, high, low):
+    """
+    Onset times of the flashes in a trace.
+
+    Args:
+        times (np.ndarray): Timestamp of each sample
+        volts (np.ndarray): Photodiode signal
+        high (float): Level the signal has to rise above for an onset
+        low (float): Level it has to fall below before the next onset
+
+    Returns:
+        np.ndarray: Time each onset crossed the high level
+    """
+    volts = np.asarray(volts, dtype=float)
+    # 1 above high, 0 below low, carried forward in between; dark at the start
+    marks = np.where(volts >= high, 1, np.where(volts <= low, 0, -1))
+    marked = np.where(marks >= 0, np.arange(len(marks)), -1)
+    last_mark = np.maximum.accumulate(marked) if len(marked) else marked
+    state = np.where(last_mark >= 0, marks[last_mark], 0)
+
+    rising = np.flatnonzero(np.diff(state) == 1) + 1
+    # Interpolate the crossing of the high level from the sample before
+    before, after = volts[rising - 1], volts[rising]
+    fraction = np.clip((high - before) / (after - before), 0, 1)
+    return times[rising - 1] + fraction * (times[rising] - times[rising - 1])
+
+
+def match_onsets(onsets, expected, max_lag):
+    """
+    First onset in [expected - EARLY_TOLERANCE, expected + max_lag) for each
+    expected time, NaN where there is none.
+    """
+    expected = np.asarray(expected, dtype=float)
+    index = np.searchsorted(onsets, expected - EARLY_TOLERANCE)
+    candidate = np.append(onsets, np.inf)[index]
+    return np.where(candidate < expected + max_lag, candidate, np.nan)
+
+
+def match_triggers(trigger_flips, flips, tolerance):
+    """
+    Index of the trigger sent on each flip (within tolerance after it), -1 where
+    no trigger was sent.
+    """
+    trigger_flips = np.asarray(trigger_flips, dtype=float)
+    index = np.searchsorted(trigger_flips, flips)
+    candidate = np.append(trigger_flips, np.inf)[index]
+    return np.where(candidate - flips <= tolerance, index, -1)
+
+
+def _ms_stats(values, prefix):
+    valid = values[np.isfinite(values)] * 1000
+    return {
+        f'{prefix}_mean_ms': float(valid.mean()) if len(valid) else None,
+        f'{prefix}_sd_ms': float(valid.std(ddof=1)) if len(valid) > 1 else None,
+        f'{prefix}_max_ms': float(valid.max()) if len(valid) else None,
+    }
+
+
+def onset_metrics(times, volts, item_flips, trigger_timeline, max_lag, flip_tolerance):
+    """
+    Match the flashes in a trial's photodiode trace to its item flips and triggers.
+
+    Args:
+        times (np.ndarray): Timestamp of each photodiode sample
+        volts (np.ndarray): Photodiode signal
+        item_flips (np.ndarray): Flip time of each item onset (patch white)
+        trigger_timeline (np.ndarray): The trial's TRIGGER_LOG_DTYPE records
+        max_lag (float): Longest flip-to-photon latency accepted, at most the
+            time between item onsets
+        flip_tolerance (float): Longest time from a flip to the trigger
+            dispatched on it
+
+    Returns:
+        dict: Per-item latencies (ms, None where no onset was found) and the
+              mean, SD (jitter) and maximum of the flip-to-photon and
+              trigger-to-photon latencies
+    """
+    item_flips = np.asarray(item_flips, dtype=float)
+    levels = hysteresis_levels(volts)
+    onsets = detect_onsets(times, volts, *levels) if levels is not None else np.empty(0)
+    photon_times = match_onsets(onsets, item_flips, max_lag)
+
+    latencies = photon_times - item_flips
+    triggered = match_triggers(trigger_timeline['flip'], item_flips, flip_tolerance)
+    trigger_to_photon = np.full(len(item_flips), np.nan)
+    has_trigger = triggered >= 0
+    trigger_to_photon[has_trigger] = photon_times[has_trigger] - trigger_timeline['sent'][triggered[has_trigger]]
+
+    def as_ms(values):
+        return [None if np.isnan(value) else float(value) * 1000 for value in values]
+
+    metrics = {
+        'photodiode_onset_count': len(onsets),
+        'photodiode_missed_onsets': int(np.isnan(photon_times).sum()),
+        'photodiode_extra_onsets': len(onsets) - int(np.isfinite(photon_times).sum()),
+        'photodiode_latencies_ms': as_ms(latencies),
+        'trigger_to_photon_ms': as_ms(trigger_to_photon[has_trigger]),
+    }
+    metrics.update(_ms_stats(latencies, 'photodiode_latency'))
+    metrics.update(_ms_stats(trigger_to_photon, 'trigger_to_photon'))
+    return metrics
@@ -0,0 +1,79 @@
+"""
+Key handling for the typed response prompts.
+
+Each prompt type (letter, symbol) gets a ResponseSpec that is compiled once at
+startup: the characters it accepts, the key names to listen for and the map
+from key name to character. collect_response() only looks keys up in the spec,
+so nothing is rebuilt when a prompt appears.
+"""
+
+import string
+from collections import namedtuple
+from types import MappingProxyType
+
+ENTER_KEYS = ('return', 'enter', 'num_enter')
+BACKSPACE_KEY = 'backspace'
+ESCAPE_KEY = 'escape'
+
+# Every key name (across the event and psychtoolbox backends) that types each character
+CHAR_KEY_NAMES = {letter: (letter.lower(),) for letter in string.ascii_uppercase}
+CHAR_KEY_NAMES.update({
+    '-': ('minus', 'hyphen', 'dash', 'num_subtract', 'kp_subtract'),
+    '=': ('equal', 'kp_equal'),
+    '+': ('plus', 'kp_add', 'num_add'),
+})
+
+# Keys that type a different character with Shift held, where the backend reports it
+SHIFT_KEY_NAMES = {'+': ('equal',)}
+
+# allowed_chars: frozenset of accepted characters
+# key_list: tuple of every key name to listen for, including Enter, Backspace and Escape
+# key_to_char / shift_key_to_char: read-only maps from key name to character
+# single_char: a new character replaces the response instead of being appended
+ResponseSpec = namedtuple('ResponseSpec', ['name', 'allowed_chars', 'key_list', 'key_to_char',
+                                           'shift_key_to_char', 'single_char'])
+
+
+def compile_response_spec(name, allowed_chars, single_char=False):
+    """
+    Build the spec for a prompt that accepts allowed_chars.
+
+    Args:
+        name (str): Prompt type, e.g. 'letter'
+        allowed_chars (iterable): Characters the prompt accepts
+        single_char (bool): Keep only the last character typed
+
+    Returns:
+        ResponseSpec: The compiled spec
+    """
+    allowed_chars = frozenset(char.upper() for char in allowed_chars)
+    unknown = allowed_chars - CHAR_KEY_NAMES.keys()
+    if unknown:
+        raise ValueError(f"No key names known for {sorted(unknown)}")
+
+    key_to_char = {key: char for char in sorted(allowed_chars) for key in CHAR_KEY_NAMES[char]}
+    shift_key_to_char = {key: char for char in sorted(allowed_chars) for key in SHIFT_KEY_NAMES.get(char, ())}
+    key_list = tuple(sorted(key_to_char.keys() | shift_key_to_char.keys())) + ENTER_KEYS + (BACKSPACE_KEY, ESCAPE_KEY)
+
+    return ResponseSpec(name=name,
+                        allowed_chars=allowed_chars,
+                        key_list=key_list,
+                        key_to_char=MappingProxyType(key_to_char),
+                        shift_key_to_char=MappingProxyType(shift_key_to_char),
+                        single_char=single_char)
+
+
+def build_response_specs(end_symbols):
+    """
+    Build the registry of prompt specs, keyed by prompt type.
+
+    Args:
+        end_symbols (list): Symbols that can end a stream
+
+    Returns:
+        dict: 'letter' (any of A-Z, appended) and 'symbol' (one of end_symbols)
+    """
+    return {
+        'letter': compile_response_spec('letter', string.ascii_uppercase),
+        'symbol': compile_response_spec('symbol', end_symbols, single_char=True),
+    }
@@ -6,11 +6,18 @@ Runs separate blocks for left and right eyes.
 """
 
 from psychopy import core, visual, gui, data, event, logging, monitors
-import random
+from psychopy.hardware import keyboard
+import rsvp_streams
+import stimulus_sizes
+from event_log import EventBuffer
+import trial_log
+import session_export
+import response_specs
+import numpy as np
 import os
 import csv
 from datetime import datetime
-import serial
+import serial_trigger
 
 # --- Constants ---
 TARGET_LETTERS = ['C', 'D', 'H', 'K', 'N', 'F', 'R', 'S', 'V', 'Z']
@@ -27,6 +34,7 @@ FIXATION_SYMBOLS = ['+', '=']  # Symbols used for the end of stream
 SERIAL_PORT_AVAILABLE = True
 SERIAL_PORT_NAME = '/dev/cu.usbmodem11301'  # Testing for now 
 SERIAL_BAUD_RATE = 115200
+SERIAL_PULSE_WIDTH = 0.010  # Seconds before the trigger is reset to 0
 
 # --- Item Duration ---
 ITEM_DURATION_MS = 110  # Target duration in milliseconds
@@ -36,6 +44,8 @@ N_TRIALS_PER_SIZE = 1
 N_PRACTICE_TRIALS = 2 
 CONDITIONS_FILE = 'conditions.csv'
 DATA_FOLDER = 'data' # Folder to save data files
+TRIAL_LOG_FSYNC_EVERY = 5 # Trials written between fsyncs of the trial log
+PARQUET_DATASET_FOLDER = os.path.join(DATA_FOLDER, 'dataset') # Study-wide Parquet dataset (needs pyarrow)
 
 # --- Trigger Values ---
 TRIGGER_STREAM_START = 101    # First item onset
@@ -67,15 +77,28 @@ TRIGGER_MAP = {
     'Z': 19
 }
 
+STREAM_SPEC = rsvp_streams.StreamSpec(target_letters=TARGET_LETTERS,
+                                      distractors=DISTRACTORS,
+                                      end_symbols=FIXATION_SYMBOLS,
+                                      n_items=N_STREAM_ITEMS,
+                                      target_pos_min=TARGET_POS_MIN,
+                                      target_pos_max=TARGET_POS_MAX)
+
+# --- Response collection ---
+# Keypresses are timestamped by the psychtoolbox keyboard queue, so this only
+# sets how quickly the typed text is redrawn, not the timing of responses
+RESPONSE_POLL_INTERVAL = 0.005
+# Key maps for the letter and symbol prompts, compiled once
+RESPONSE_SPECS = response_specs.build_response_specs(FIXATION_SYMBOLS)
+
 def initialize_serial_port():
     """Initialize the serial port for sending triggers to BioSemi/LabJack."""
     if SERIAL_PORT_AVAILABLE:
         try:
-            ser = serial.Serial(
-                port=SERIAL_PORT_NAME,
-                baudrate=SERIAL_BAUD_RATE
-            )
-            ser.write(bytes([0]))
+            # Timestamp triggers on the same clock as win.flip()
+            serial_trigger.clock = core.monotonicClock.getTime
+            serial_trigger.PULSE_WIDTH = SERIAL_PULSE_WIDTH
+            ser = serial_trigger.configure(SERIAL_PORT_NAME, SERIAL_BAUD_RATE)
             print(f"Serial port initialized at {SERIAL_PORT_NAME}, baudrate {SERIAL_BAUD_RATE}")
             return ser
         except Exception as e:
@@ -86,33 +109,25 @@ def initialize_serial_port():
 
 
 def send_trigger(port, trigger_value):
-    """Send a trigger value to the serial port."""
+    """
+    Schedule a trigger value to be queued for the serial writer thread straight
+    after the next flip. Trigger timing is logged after the trial by
+    serial_trigger.dump_log. Without a serial port nothing is done here: that
+    is logged once at startup and the trigger codes are still in the stream
+    events.
+    """
     if port is not None and SERIAL_PORT_AVAILABLE:
-        port.write(bytes([trigger_value]))
-        logging.exp(f"TRIGGER: Sent value {trigger_value} to serial port")
-        port.write(bytes([0]))  # Reset trigger, not sure if needed
-    else:
-        logging.exp(f"TRIGGER: Simulated sending value {trigger_value} to serial port")
+        win.callOnFlip(dispatch_trigger_on_flip, trigger_value)
 
 
-def logmar_to_degrees(logmar_value):
+def dispatch_trigger_on_flip(trigger_value):
     """
-    Convert LogMAR value to degrees of visual angle.
-    
-    LogMAR = log10(MAR), where MAR = size in arcmin / 5
-    So, size in arcmin = 5 * 10^LogMAR
-    Then convert arcmin to degrees (1 degree = 60 arcmin)
-    
-    Args:
-        logmar_value (float): The LogMAR value to convert
-        
-    Returns:
-        float: Size in degrees of visual angle
+    win.callOnFlip callback, so it runs right after the buffer swap rather
+    than up to a frame before the photons. Hands the trigger to the serial
+    writer along with the flip time.
     """
-    size_arcmin = 5 * (10 ** logmar_value)
-    size_degrees = size_arcmin / 30.0 # not sure why, but the font used is 30 arcmin
-    
-    return size_degrees
+    serial_trigger.trigger(trigger_value, flip_time=core.monotonicClock.getTime())
+
 
 # --- Experiment Setup ---
 exp_info = {
@@ -144,9 +159,13 @@ if not os.path.exists(DATA_FOLDER):
 exp = data.ExperimentHandler(name='RSVP_Size', version='1.0',
                              extraInfo=exp_info, runtimeInfo=True,
                              originPath=__file__,
-                             savePickle=True, saveWideText=True,
+                             savePickle=True, saveWideText=False,  # CSV is derived from the trial log
                              dataFileName=filename)
 
+# Each trial is appended here as soon as it ends, so a crash keeps the data
+# collected so far
+trial_writer = trial_log.TrialLogWriter(filename + '_trials.jsonl', fsync_every=TRIAL_LOG_FSYNC_EVERY)
+
 logFile = logging.LogFile(filename + '.log', level=logging.EXP)
 logging.console.setLevel(logging.WARNING)
 
@@ -191,6 +210,8 @@ print(f"Item duration: {ITEM_DURATION_FRAMES} frames ({ITEM_DURATION_FRAMES * fr
 print(f"Practice duration: {PRACTICE_DURATION_FRAMES} frames ({PRACTICE_DURATION_FRAMES * frameDur * 1000:.2f} ms)")
 
 port = initialize_serial_port()
+if port is None or not SERIAL_PORT_AVAILABLE:
+    logging.warning("TRIGGER: Serial port not available, triggers are simulated this session")
 
 
 snellen_font = 'Optician Sans'  # Font for stimuli
@@ -225,26 +246,29 @@ goodbye_text = visual.TextStim(win=win, text="Thank you for participating!\nThe
 rsvp_stim = visual.TextStim(win=win, text='', height=1.0, font=snellen_font) 
 
 kb = event.BuilderKeyResponse()
+# Background HID reader for typed responses
+response_kb = keyboard.Keyboard()
 
 
 trial_conditions = data.importConditions(CONDITIONS_FILE)
 
-min_size = float('inf')
-max_size = float('-inf')
+if any('logmar' not in condition and 'stimSizeDeg' not in condition for condition in trial_conditions):
+    raise ValueError("Neither 'logmar' nor 'stimSizeDeg' found in conditions file")
 
+# Convert every LogMAR level at once for this monitor, viewing distance and font
+size_table = stimulus_sizes.monitor_size_table(
+    [condition['logmar'] for condition in trial_conditions if 'logmar' in condition], mon, snellen_font)
+degrees_by_logmar = dict(zip(size_table.logmar.tolist(), size_table.degrees.tolist()))
+pixel_height_by_logmar = dict(zip(size_table.logmar.tolist(), size_table.pixel_height.tolist()))
 for condition in trial_conditions:
     if 'logmar' in condition:
-        logmar_value = float(condition['logmar'])
-        condition['stimSizeDeg'] = logmar_to_degrees(logmar_value)
-        
-        min_size = min(min_size, condition['stimSizeDeg'])
-        max_size = max(max_size, condition['stimSizeDeg'])
-        
-        print(f"Converting LogMAR {logmar_value} to {condition['stimSizeDeg']} degrees")
-    elif 'stimSizeDeg' not in condition:
-        raise ValueError("Neither 'logmar' nor 'stimSizeDeg' found in conditions file")
+        condition['stimSizeDeg'] = degrees_by_logmar[float(condition['logmar'])]
 
-print(f"Size range: {min_size} to {max_size} degrees of visual angle")
+sizes = [condition['stimSizeDeg'] for condition in trial_conditions]
+print(f"Size range: {min(sizes)} to {max(sizes)} degrees of visual angle")
+for warning in stimulus_sizes.size_warnings(size_table):
+    print(f"WARNING: {warning}")
+    logging.warning(warning)
 
 trial_conditions = sorted(trial_conditions, key=lambda x: x['stimSizeDeg'], reverse=True)
 
@@ -259,6 +283,9 @@ print(f"Loaded {n_sizes} stimulus sizes from {CONDITIONS_FILE}.")
 print(f"Total trials per main block part: {n_total_trials_per_block}")
 
 practice_trials_list = [trial_conditions[0]] * N_PRACTICE_TRIALS
+
+# Streams are freshly randomised for every session, generated a block at a time
+stream_rng = np.random.default_rng()
 practice_handler = data.TrialHandler(nReps=1, method='random',
                                      originPath=-1,
                                      trialList=practice_trials_list,
@@ -275,169 +302,160 @@ trials_no_response = data.TrialHandler(nReps=1, method='sequential',
                                       trialList=expanded_trial_list,
                                       name='trials_no_response')
 
-def show_message(text_stim, wait_keys=['space', 'return', 'enter']):
-    """Displays a TextStim and waits for a key press."""
+def show_message(text_stim, wait_keys=['space', 'return', 'enter'], while_waiting=None):
+    """Displays a TextStim and waits for a key press.
+    while_waiting, if given, is called once the message is on screen."""
     text_stim.draw()
     win.flip()
+    if while_waiting is not None:
+        while_waiting()
     event.waitKeys(keyList=wait_keys)
     win.flip()
 
-def collect_response(prompt_stim, typed_stim, expected_chars_list=None):
+def collect_response(spec, prompt_stim, typed_stim):
     """Collects a typed response until Enter is pressed.
-    Handles mapping of PsychoPy key names to characters for letters, '+', and '='.
-    Correctly interprets Shift + '=' as '+'.
+    spec is a ResponseSpec from RESPONSE_SPECS, which gives the keys to listen
+    for and the character each one types.
+    Waits on the psychtoolbox keyboard queue and only redraws when the typed
+    text changes, so nothing is rendered while the participant is thinking.
+    Returns the response, the flip time of the prompt and a list of
+    (key name, time from prompt onset) for every key handled. The keyboard
+    clock is reset on the prompt's flip, so key.rt is measured from the prompt
+    whatever clock the keyboard backend timestamps keys on.
     """
     response_str = ""
     typed_stim.text = ""
-    # Initial prompt display is now done after setting up listeners
-
-    # PsychoPy key names and their corresponding characters (for direct mapping)
-    # The 'equal' key is handled specially below to check for the Shift modifier.
-    key_name_to_char_map = {
-        'a': 'A', 'b': 'B', 'c': 'C', 'd': 'D', 'e': 'E', 'f': 'F', 'g': 'G',
-        'h': 'H', 'i': 'I', 'j': 'J', 'k': 'K', 'l': 'L', 'm': 'M', 'n': 'N',
-        'o': 'O', 'p': 'P', 'q': 'Q', 'r': 'R', 's': 'S', 't': 'T', 'u': 'U',
-        'v': 'V', 'w': 'W', 'x': 'X', 'y': 'Y', 'z': 'Z',
-        'plus': '+',        # For a dedicated '+' key (e.g., on numpad or some keyboards)
-        'kp_add': '+',      # Numpad '+'
-        'kp_equal': '=',    # Numpad '=' (if it exists and is used)
-    }
-
-    active_allowed_chars = []
-    # Determine active_allowed_chars based on the prompt type
-    if prompt_stim == symbol_prompt_text: # Symbol prompt
-        # expected_chars_list is ['+', '='] when called for symbol prompt
-        active_allowed_chars = [char.upper() for char in expected_chars_list if char in ['+', '=']] if expected_chars_list else ['+', '=']
-    elif prompt_stim == response_prompt_text: # Letter prompt
-        # expected_chars_list is None when called for letter prompt
-        active_allowed_chars = [chr(ord('A') + i) for i in range(26)] # Default to all uppercase letters
-        if expected_chars_list: # This part is not currently used but allows for future restriction
-            # active_allowed_chars = [char.upper() for char in expected_chars_list if char.isalpha()]
-            pass
-
-
-    # Determine which base key names to listen for
-    base_listen_keys = ['backspace', 'return', 'enter', 'escape']
-    # Check if any uppercase letter A-Z is in active_allowed_chars
-    if any(chr(ord('A') + i) in active_allowed_chars for i in range(26)):
-        for i in range(26):
-            base_listen_keys.append(chr(ord('a') + i)) # Listen for 'a', 'b', ...
-
-    if '+' in active_allowed_chars or '=' in active_allowed_chars:
-        base_listen_keys.extend(['equal', 'plus', 'kp_add', 'kp_equal'])
-
-    listen_for_key_names = list(set(base_listen_keys)) # Ensure unique key names
-
-    # Initial display of prompt
+    key_times = []
+
+    # Initial display of prompt; keys pressed before it appeared are discarded
     prompt_stim.draw()
     typed_stim.draw() # Initially empty
-    win.flip()
+    win.callOnFlip(response_kb.clock.reset)
+    prompt_onset = win.flip()
+    response_kb.clearEvents()
 
     break_loop = False
     while not break_loop:
-        # Get all key events in this frame, with modifiers
-        keys_with_mods = event.getKeys(keyList=listen_for_key_names, modifiers=True)
-
-        if not keys_with_mods: 
-            prompt_stim.draw()
-            typed_stim.draw()
-            win.flip()
-            core.wait(0.001) 
-            continue 
-
-        # Process each key event from this frame
-        for key_name_pressed, mods in keys_with_mods:
-            if key_name_pressed in ['escape']:
+        # Key-down events since the last check, timestamped by the keyboard queue
+        keys = response_kb.getKeys(keyList=spec.key_list, waitRelease=False, clear=True)
+
+        if not keys:
+            # Sleep rather than flip; core.wait keeps the window responsive
+            core.wait(RESPONSE_POLL_INTERVAL, hogCPUperiod=0)
+            continue
+
+        # Process each key event since the last check
+        for key in keys:
+            key_name_pressed = key.name
+            if key_name_pressed == response_specs.ESCAPE_KEY:
                 print("User aborted experiment.")
                 core.quit() 
-                return ""  # Should not be reached if core.quit() works
+                return "", prompt_onset, key_times  # Should not be reached if core.quit() works
             
-            elif key_name_pressed in ['return', 'enter']:
+            elif key_name_pressed in response_specs.ENTER_KEYS:
                 if response_str: # Only accept if there's a response
+                    key_times.append((key_name_pressed, key.rt))
                     break_loop = True # Signal to break outer while-loop
-                    break # Exit this inner for-loop (over keys_with_mods)
+                    break # Exit this inner for-loop (over keys)
                 else:
-                    # No response yet, ignore enter, continue processing other keys in this frame if any
+                    # No response yet, ignore enter, continue processing other keys if any
                     continue 
-            
-            elif key_name_pressed == 'backspace':
+
+            elif key_name_pressed == response_specs.BACKSPACE_KEY:
+                key_times.append((key_name_pressed, key.rt))
                 response_str = response_str[:-1]
                 # typed_stim.text will be updated before the flip
             
             else: # Character input keys
-                char_to_add = None
-                is_shift_pressed = mods.get('shift', False)
-
-                if key_name_pressed == 'equal': # Handle '=' and Shift+'=' -> '+'
-                    char_to_add = '+' if is_shift_pressed else '='
-                elif key_name_pressed in key_name_to_char_map: # For letters and other mapped keys ('plus', 'kp_add', 'kp_equal')
-                    char_to_add = key_name_to_char_map[key_name_pressed]
-                
-                if char_to_add and char_to_add in active_allowed_chars:
-                    if prompt_stim == symbol_prompt_text:
+                char_to_add = spec.key_to_char.get(key_name_pressed)
+                if char_to_add:
+                    key_times.append((key_name_pressed, key.rt))
+                    if spec.single_char:
                         # For symbol prompt, overwrite to ensure only one symbol
                         response_str = char_to_add
-                    elif prompt_stim == response_prompt_text: # For letter prompt, append
+                    else: # For letter prompt, append
                         response_str += char_to_add
         
-        # After processing all keys for this frame, update display
-        typed_stim.text = response_str
-        prompt_stim.draw()
-        typed_stim.draw()
-        win.flip()
+        # After processing the keys, redraw only if the typed text changed
+        if not break_loop and typed_stim.text != response_str:
+            typed_stim.text = response_str
+            prompt_stim.draw()
+            typed_stim.draw()
+            win.flip()
 
     # break_loop is true, meaning 'return'/'enter' was pressed with a valid response
     win.flip() # Clear the prompt/response from screen
-    return response_str
+    return response_str, prompt_onset, key_times
 
-def run_rsvp_trial(win, stim_size_deg, item_duration_frames, require_response=True, end_fix_duration=FIXATION_POST_STREAM_RESPONSE_DUR):
-    target_letter = random.choice(TARGET_LETTERS)
-    target_position = random.randint(TARGET_POS_MIN, TARGET_POS_MAX)
-    end_symbol = random.choice(FIXATION_SYMBOLS)  # Randomly choose + or =
 
-    stream = []
-    for i in range(N_STREAM_ITEMS):
-        if i == target_position:
-            stream.append(target_letter)
-        else:
-            distractor = random.choice(DISTRACTORS)
-            while stream and distractor == stream[-1]:
-                distractor = random.choice(DISTRACTORS)
-            stream.append(distractor)
+def add_response_timing(trial_metrics, prefix, prompt_onset, key_times):
+    """
+    Add the keys and reaction times of one response to trial_metrics.
+    first_key_rt is the first key handled (letter, symbol or backspace) and
+    enter_rt the Enter that accepted the response, both from prompt onset.
+    key_times are the key presses on the win.flip() and trigger clock.
+    """
+    trial_metrics[f'{prefix}_prompt_onset'] = prompt_onset
+    trial_metrics[f'{prefix}_keys'] = [name for name, _ in key_times]
+    trial_metrics[f'{prefix}_key_times'] = [prompt_onset + rt for _, rt in key_times]
+    trial_metrics[f'{prefix}_first_key_rt'] = key_times[0][1] if key_times else None
+    trial_metrics[f'{prefix}_enter_rt'] = key_times[-1][1] if key_times else None
+
+# Log label of each stream event; events are recorded by index during the
+# stream and only formatted once it is over
+EVENT_LABELS = ["RSVP Stream Start", "Target Letter Onset", "Stimulus Onset",
+                "Pre-target -2 stimulus", "Pre-target -1 stimulus", "Post-target +1 stimulus",
+                "RSVP Stream End"]
+EVENT_STREAM_START, EVENT_TARGET_ONSET, EVENT_STIMULUS_ONSET = 0, 1, 2
+EVENT_STREAM_END = 6
+# Context events keyed by offset from the target position
+CONTEXT_EVENTS = {-2: 3, -1: 4, 1: 5}
+trial_events = EventBuffer(EVENT_LABELS)
+
+def run_rsvp_trial(win, stim_size_deg, item_duration_frames, require_response=True, end_fix_duration=FIXATION_POST_STREAM_RESPONSE_DUR, trial_plan=None):
+    # The target, end symbol and stream come from the block's generated streams
+    target_letter = trial_plan['target_letter']
+    target_position = trial_plan['target_position']
+    end_symbol = trial_plan['end_symbol']  # + or =
+    stream = trial_plan['stream']
+
+    trial_events.clear()
 
     # Display fixation cross before the stream
     fixation_cross.draw()
     win.flip()
     core.wait(FIXATION_PRE_STREAM_DUR)
 
-    # RSVP stream presentation
+    # Timestamp of every flip in the stream, plus the flip that shows the end symbol
+    flip_times = np.empty(len(stream) * item_duration_frames + 1)
+
+    # RSVP stream presentation. Events are only recorded here and are written
+    # to the log once the stream is over.
     for i, item in enumerate(stream):
         rsvp_stim.setText(item)
         rsvp_stim.height = stim_size_deg
-          for frame in range(item_duration_frames):
+        for frame in range(item_duration_frames):
+            flip_index = i * item_duration_frames + frame
             if i == 0 and frame == 0:
                 send_trigger(port, TRIGGER_STREAM_START)
-                logging.exp(f"RSVP Stream Start - Item: {item}")
+                trial_events.record(flip_index, EVENT_STREAM_START, item, TRIGGER_STREAM_START)
             
             if i == target_position and frame == 0:
                 send_trigger(port, TRIGGER_TARGET_ONSET)
-                logging.exp(f"Target Letter Onset - Letter: {item}")
+                trial_events.record(flip_index, EVENT_TARGET_ONSET, item, TRIGGER_TARGET_ONSET)
             
             if frame == 0:
                 # Send item-specific trigger for each stimulus
                 send_trigger(port, TRIGGER_MAP[item])
-                logging.exp(f"Stimulus Onset - Item: {item}, Trigger: {TRIGGER_MAP[item]}")
+                trial_events.record(flip_index, EVENT_STIMULUS_ONSET, item, TRIGGER_MAP[item])
                 
-                # Also send specific triggers for context around target
-                if i == target_position - 2:
-                    logging.exp(f"Pre-target -2 stimulus - Item: {item}, Trigger: {TRIGGER_MAP[item]}")
-                elif i == target_position - 1:
-                    logging.exp(f"Pre-target -1 stimulus - Item: {item}, Trigger: {TRIGGER_MAP[item]}")
-                elif i == target_position + 1:
-                    logging.exp(f"Post-target +1 stimulus - Item: {item}, Trigger: {TRIGGER_MAP[item]}")
+                # Also log the context around the target
+                context_event = CONTEXT_EVENTS.get(i - target_position)
+                if context_event is not None:
+                    trial_events.record(flip_index, context_event, item, TRIGGER_MAP[item])
 
             rsvp_stim.draw()
-            win.flip()
+            flip_times[flip_index] = win.flip()
 
     # Display the end symbol (+ or =)
     if end_symbol == '+':
@@ -446,33 +464,43 @@ def run_rsvp_trial(win, stim_size_deg, item_duration_frames, require_response=Tr
         equal_sign.draw()
     
     send_trigger(port, TRIGGER_STREAM_END)
-    logging.exp(f"RSVP Stream End - End symbol: {end_symbol}") # Log the chosen end symbol
+    trial_events.record(len(flip_times) - 1, EVENT_STREAM_END, end_symbol, TRIGGER_STREAM_END)
     
-    win.flip()
+    flip_times[-1] = win.flip()
     core.wait(end_fix_duration) # Display the end symbol for the specified duration
     win.flip() # Clear the screen
 
+    # Write out the stream events, timestamped with the flips they were shown on
+    trial_events.stamp(flip_times)
+    trial_events.dump(logging.exp)
+
+    # Write out the trial's trigger timing now that the stream is over
+    serial_trigger.dump_log(logging.exp)
+
     letter_response = None
     letter_accuracy = None
     symbol_response = None
     symbol_accuracy = None
+    trial_metrics = {}
 
     if require_response:
-        letter_response = collect_response(response_prompt_text, typed_response_text, expected_chars_list=None) # Defaults to A-Z
+        letter_response, letter_prompt_onset, letter_key_times = collect_response(RESPONSE_SPECS['letter'], response_prompt_text, typed_response_text)
         letter_accuracy = 1 if letter_response == target_letter else 0
+        add_response_timing(trial_metrics, 'letter', letter_prompt_onset, letter_key_times)
     else:
         letter_response = 'N/A'
         letter_accuracy = 'N/A'
       # Always collect symbol response
-    symbol_response = collect_response(symbol_prompt_text, typed_symbol_text, expected_chars_list=['+', '='])
+    symbol_response, symbol_prompt_onset, symbol_key_times = collect_response(RESPONSE_SPECS['symbol'], symbol_prompt_text, typed_symbol_text)
     symbol_accuracy = 1 if symbol_response == end_symbol else 0
+    add_response_timing(trial_metrics, 'symbol', symbol_prompt_onset, symbol_key_times)
 
     # Extract pre-target and post-target stimuli for data logging
     pre_target_2 = stream[target_position - 2] if target_position >= 2 else 'N/A'
     pre_target_1 = stream[target_position - 1] if target_position >= 1 else 'N/A'
     post_target_1 = stream[target_position + 1] if target_position + 1 < len(stream) else 'N/A'
 
-    return target_letter, target_position, stream, letter_response, letter_accuracy, end_symbol, symbol_response, symbol_accuracy, pre_target_2, pre_target_1, post_target_1
+    return target_letter, target_position, stream, letter_response, letter_accuracy, end_symbol, symbol_response, symbol_accuracy, pre_target_2, pre_target_1, post_target_1, trial_metrics
 
 def run_font_size_test_mode(win):
     """
@@ -486,16 +514,15 @@ def run_font_size_test_mode(win):
     test_stim = visual.TextStim(win=win, text='R', height=1.0, font=snellen_font)  # Using 'A' as a standard test letter
     size_info_text = visual.TextStim(win=win, text='', pos=(0, -3), height=0.5, wrapWidth=20.5)
     
-    # Sort conditions from largest to smallest size
-    sorted_conditions = sorted(trial_conditions, key=lambda x: x['stimSizeDeg'], reverse=True)
-    
-    for condition in sorted_conditions:
+    # trial_conditions is already sorted from largest to smallest size
+    for condition in trial_conditions:
         stim_size = condition['stimSizeDeg']
         logmar = condition.get('logmar', 'N/A')
+        pixel_height = pixel_height_by_logmar.get(float(logmar), 'N/A') if logmar != 'N/A' else 'N/A'
         
         # Display the letter at this size
         test_stim.height = stim_size
-        size_info_text.text = f"Size: {stim_size:.4f} degrees (LogMAR: {logmar})"
+        size_info_text.text = f"Size: {stim_size:.4f} degrees, {pixel_height} px (LogMAR: {logmar})"
         
         test_stim.draw()
         size_info_text.draw()
@@ -529,9 +556,10 @@ if exp_info['Test Mode'] == 'Yes':
     
     # Clean up and exit
     if port is not None and SERIAL_PORT_AVAILABLE:
-        port.write(bytes([0]))
+        serial_trigger.close()  # Send any queued triggers and leave the port at 0
         logging.exp("Serial port reset at experiment end")
     
+    trial_writer.close()
     win.close()
     core.quit()
 else:
@@ -539,15 +567,17 @@ else:
     show_message(instruction_text)
     
     show_message(practice_instruction_text)
+    practice_streams = rsvp_streams.generate_block(practice_trials_list, stream_rng, STREAM_SPEC)
     current_trial_global = 0
     for trial_num_practice, practice_trial_data in enumerate(practice_handler):
         current_trial_global += 1
         stim_size = practice_trial_data['stimSizeDeg']
-          target, pos, stream_items, l_resp, l_acc, e_sym, s_resp, s_acc, pre_t2, pre_t1, post_t1 = run_rsvp_trial(win,
+        target, pos, stream_items, l_resp, l_acc, e_sym, s_resp, s_acc, pre_t2, pre_t1, post_t1, trial_metrics = run_rsvp_trial(win,
                                              stim_size_deg=stim_size,
                                              item_duration_frames=PRACTICE_DURATION_FRAMES,
                                              require_response=True,
-                                             end_fix_duration=FIXATION_POST_STREAM_RESPONSE_DUR)
+                                             end_fix_duration=FIXATION_POST_STREAM_RESPONSE_DUR,
+                                             trial_plan=practice_streams[trial_num_practice])
 
         practice_handler.addData('block_type', 'practice')
         practice_handler.addData('trial_num_block', trial_num_practice + 1)
@@ -561,9 +591,10 @@ else:
         practice_handler.addData('symbol_response', s_resp)
         practice_handler.addData('symbol_accuracy', s_acc)
         exp.nextEntry()
+        trial_writer.append(exp.entries[-1])
 
         if trial_num_practice < N_PRACTICE_TRIALS - 1:
-            show_message(next_trial_text, wait_keys=['space'])
+            show_message(next_trial_text, wait_keys=['space'], while_waiting=trial_writer.sync)
 
     for eye in ['left', 'right']:
 
@@ -584,16 +615,21 @@ else:
                                               trialList=expanded_trial_list,
                                               name='trials_no_response')
 
+        response_streams = rsvp_streams.generate_block(expanded_trial_list, stream_rng, STREAM_SPEC)
+        no_response_streams = rsvp_streams.generate_block(expanded_trial_list, stream_rng, STREAM_SPEC)
+
         print(f"\n--- Starting {eye.capitalize()} Eye Block - Part 1 (Response) ---")
         exp.addLoop(trials_response)
         for trial_num_block, trial_data in enumerate(trials_response):
             current_trial_global += 1
-            stim_size = trial_data['stimSizeDeg']            target, pos, stream_items, l_resp, l_acc, e_sym, s_resp, s_acc, pre_t2, pre_t1, post_t1 = run_rsvp_trial(
+            stim_size = trial_data['stimSizeDeg']
+            target, pos, stream_items, l_resp, l_acc, e_sym, s_resp, s_acc, pre_t2, pre_t1, post_t1, trial_metrics = run_rsvp_trial(
                 win,
                 stim_size_deg=stim_size,
                 item_duration_frames=ITEM_DURATION_FRAMES,
                 require_response=True,
-                end_fix_duration=FIXATION_POST_STREAM_RESPONSE_DUR
+                end_fix_duration=FIXATION_POST_STREAM_RESPONSE_DUR,
+                trial_plan=response_streams[trial_num_block]
             )
 
             trials_response.addData('block_type', f'{block_prefix}_response')
@@ -607,11 +643,15 @@ else:
             trials_response.addData('end_symbol', e_sym)
             trials_response.addData('symbol_response', s_resp)
             trials_response.addData('symbol_accuracy', s_acc)
+            for key, value in trial_metrics.items():
+                trials_response.addData(key, value)
             exp.nextEntry()
+            trial_writer.append(exp.entries[-1])
 
             if trial_num_block < n_total_trials_per_block - 1:
-                show_message(next_trial_text, wait_keys=['space'])
+                show_message(next_trial_text, wait_keys=['space'], while_waiting=trial_writer.sync)
             else:
+                trial_writer.sync(force=True) # End of block
                 core.wait(1.0)
 
         if eye == 'left':
@@ -621,15 +661,17 @@ else:
 
         print(f"\n--- Starting {eye.capitalize()} Eye Block - Part 2 (No Response) ---")
         exp.addLoop(trials_no_response)
-        for trial_num_block, trial_data in enumerate(trials_no_response):            current_trial_global += 1
+        for trial_num_block, trial_data in enumerate(trials_no_response):
+            current_trial_global += 1
             stim_size = trial_data['stimSizeDeg']
 
-            target, pos, stream_items, l_resp, l_acc, e_sym, s_resp, s_acc, pre_t2, pre_t1, post_t1 = run_rsvp_trial(
+            target, pos, stream_items, l_resp, l_acc, e_sym, s_resp, s_acc, pre_t2, pre_t1, post_t1, trial_metrics = run_rsvp_trial(
                 win,
                 stim_size_deg=stim_size,
                 item_duration_frames=ITEM_DURATION_FRAMES,
                 require_response=False, # Letter response not required
-                end_fix_duration=FIXATION_POST_STREAM_NO_RESPONSE_DUR
+                end_fix_duration=FIXATION_POST_STREAM_NO_RESPONSE_DUR,
+                trial_plan=no_response_streams[trial_num_block]
             )
 
             trials_no_response.addData('block_type', f'{block_prefix}_no_response')
@@ -643,11 +685,15 @@ else:
             trials_no_response.addData('end_symbol', e_sym)
             trials_no_response.addData('symbol_response', s_resp)
             trials_no_response.addData('symbol_accuracy', s_acc)
+            for key, value in trial_metrics.items():
+                trials_no_response.addData(key, value)
             exp.nextEntry()
+            trial_writer.append(exp.entries[-1])
 
             if trial_num_block < n_total_trials_per_block - 1:
-                show_message(next_trial_text, wait_keys=['space'])
+                show_message(next_trial_text, wait_keys=['space'], while_waiting=trial_writer.sync)
             else:
+                trial_writer.sync(force=True) # End of block
                 core.wait(1.0) # Wait a bit after the last trial of the no-response block
 
         if eye == 'left':
@@ -658,12 +704,20 @@ goodbye_text.draw()
 win.flip()
 core.wait(3.0)
 
-exp.saveAsWideText(filename + '.csv')
+trial_writer.close()
+n_logged_trials = trial_log.write_csv(trial_writer.path, filename + '.csv')
+print(f"Saved {n_logged_trials} trials to {filename}.csv")
+n_exported_trials = session_export.export_session(trial_writer.path, PARQUET_DATASET_FOLDER,
+                                                  exp_info['Participant ID'], os.path.basename(filename))
+if n_exported_trials is None:
+    print("pyarrow is not installed, skipping the Parquet export")
+else:
+    print(f"Exported {n_exported_trials} trials to {PARQUET_DATASET_FOLDER}")
 exp.saveAsPickle(filename + '.psydat')
 logging.flush()
 
 if port is not None and SERIAL_PORT_AVAILABLE:
-    port.write(bytes([0]))
+    serial_trigger.close()  # Send any queued triggers and leave the port at 0
     logging.exp("Serial port reset at experiment end")
 
 win.close()
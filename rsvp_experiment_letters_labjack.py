@@ -7,7 +7,20 @@ Includes a photodiode patch for precise timing measurement.
 """
 
 from psychopy import core, visual, gui, data, event, logging, monitors
+from psychopy.hardware import keyboard
 import labjackU3
+import analog_stream
+import photodiode_onsets
+from glyph_cache import GlyphCache
+from trial_schedule import compile_trial, frame_timing
+from event_log import EventBuffer
+import rsvp_streams
+import stimulus_sizes
+from adaptive_procedure import BayesianStaircase, load_likelihood_table, file_hash
+from acuity_analysis import degrees_to_logmar
+import trial_log
+import session_export
+import response_specs
 import random
 import numpy as np  # Adding numpy for better random number generation
 import os
@@ -28,19 +41,41 @@ FIXATION_SYMBOLS = ['-', '=']  # Symbols used for the end of stream - changed fr
 # --- Pseudorandom sequence generation ---
 # Use a fixed seed for reproducibility
 RANDOM_SEED = 42
+# Streams for the whole session are generated once from RANDOM_SEED and cached
+# here, so every participant and station sees the same sequences
+SESSION_STREAMS_FILE = 'session_streams.json'
 
 # --- Photodiode constants ---
 PHOTODIODE_SIZE = 0.8  # Size in degrees of visual angle
 PHOTODIODE_POSITION = (4, -2)  # Position at bottom right (adjust based on your screen)
+PHOTODIODE_AIN = 8  # U3 analog input of the photodiode: EIO0, as FIO0-7 carry the triggers
+PHOTODIODE_SCAN_HZ = 2000  # Photodiode samples per second
+PHOTODIODE_BUFFER_SECONDS = 60  # Photodiode history kept in memory
 
 # --- Item Duration ---
 ITEM_DURATION_MS = 120  # Target duration in milliseconds
 PRACTICE_SPEED_FACTOR = 0.75  # Practice speed 0-1
 
 N_TRIALS_PER_SIZE = 5 
+# --- Adaptive procedure ---
+# With Procedure 'Adaptive' the response blocks run a Bayesian staircase over
+# the LogMAR levels instead of every size N_TRIALS_PER_SIZE times
+ADAPTIVE_MAX_SD = 0.05       # Stop once the threshold's posterior SD (LogMAR) is this small
+ADAPTIVE_MIN_TRIALS = 15
+ADAPTIVE_MAX_TRIALS = 40
+LIKELIHOOD_CACHE_FOLDER = 'cache'  # Precomputed staircase likelihood tables
 N_PRACTICE_TRIALS = 2 
 CONDITIONS_FILE = 'conditions.csv'
 DATA_FOLDER = 'data' # Folder to save data files
+TRIAL_LOG_FSYNC_EVERY = 5 # Trials written between fsyncs of the trial log
+PARQUET_DATASET_FOLDER = os.path.join(DATA_FOLDER, 'dataset') # Study-wide Parquet dataset (needs pyarrow)
+
+# --- Response collection ---
+# Keypresses are timestamped by the psychtoolbox keyboard queue, so this only
+# sets how quickly the typed text is redrawn, not the timing of responses
+RESPONSE_POLL_INTERVAL = 0.005
+# Key maps for the letter and symbol prompts, compiled once
+RESPONSE_SPECS = response_specs.build_response_specs(FIXATION_SYMBOLS)
 
 # --- Trigger Values ---
 TRIGGER_STREAM_START = 101    # Stream start (sent before first item)
@@ -71,9 +106,18 @@ TRIGGER_MAP = {
     'Z': 19
 }
 
+STREAM_SPEC = rsvp_streams.StreamSpec(target_letters=TARGET_LETTERS,
+                                      distractors=DISTRACTORS,
+                                      end_symbols=FIXATION_SYMBOLS,
+                                      n_items=N_STREAM_ITEMS,
+                                      target_pos_min=TARGET_POS_MIN,
+                                      target_pos_max=TARGET_POS_MAX)
+
 def initialize_labjack():
     """Initialize the LabJack U3 for sending triggers."""
     try:
+        # Timestamp triggers on the same clock as win.flip()
+        labjackU3.clock = core.monotonicClock.getTime
         # Configure the LabJack using our custom implementation
         labjackU3.configure()
         print("LabJack U3 initialized successfully")
@@ -83,34 +127,79 @@ def initialize_labjack():
         return None
 
 
+def initialize_photodiode_stream():
+    """Start streaming the photodiode from the LabJack U3 on a background thread."""
+    try:
+        stream = analog_stream.AnalogStream(labjackU3.u3card, [PHOTODIODE_AIN], PHOTODIODE_SCAN_HZ,
+                                            buffer_seconds=PHOTODIODE_BUFFER_SECONDS,
+                                            clock=core.monotonicClock.getTime)
+        stream.start()
+        print("Photodiode stream started")
+        return stream
+    except Exception as e:
+        print(f"ERROR: Failed to start the photodiode stream: {e}")
+        return None
+
+
 def send_trigger(ljack, trigger_value):
-    """Send a trigger value to the LabJack U3."""
+    """
+    Schedule a trigger value to be sent to the LabJack U3 straight after the
+    next flip. Without a LabJack nothing is done here: the missing LabJack is
+    logged once at startup and the trigger codes are still in the stream events.
+    """
     if ljack is not None:
-        # Use our custom labjackU3 module to send the trigger
-        labjackU3.trigger(trigger_value)
-        logging.exp(f"TRIGGER: Sent value {trigger_value} to LabJack U3")
-    else:
-        logging.exp(f"TRIGGER: LabJack not available, cannot send value {trigger_value}")
+        win.callOnFlip(dispatch_trigger_on_flip, trigger_value)
 
 
-def logmar_to_degrees(logmar_value):
+def dispatch_trigger_on_flip(trigger_value):
     """
-    Convert LogMAR value to degrees of visual angle.
-    
-    LogMAR = log10(MAR), where MAR = size in arcmin / 5
-    So, size in arcmin = 5 * 10^LogMAR
-    Then convert arcmin to degrees (1 degree = 60 arcmin)
-    
-    Args:
-        logmar_value (float): The LogMAR value to convert
-        
-    Returns:
-        float: Size in degrees of visual angle
+    win.callOnFlip callback, so it runs right after the buffer swap rather
+    than up to a frame before the photons. Hands the trigger to the LabJack
+    dispatcher along with the flip time.
     """
-    size_arcmin = 5 * (10 ** logmar_value)
-    size_degrees = size_arcmin / 30.0 # not sure why, but the font used is 30 arcmin
-    
-    return size_degrees
+    labjackU3.trigger(trigger_value, flip_time=core.monotonicClock.getTime())
+
+
+def log_trigger_timeline(timeline):
+    """Log the flip and USB write times of the triggers sent during a trial."""
+    for entry in timeline:
+        logging.exp(f"TRIGGER TIMING: value {entry['code']}, flip {entry['flip']:.5f}, "
+                    f"write start {entry['sent']:.5f}, write done {entry['completed']:.5f}")
+
+
+def photodiode_trial_metrics(start, end, item_flips, trigger_timeline, item_duration):
+    """
+    Read the photodiode samples from start to end back from the stream, find
+    the flash of each item onset in them and match it to the item's flip and
+    trigger. Also reports any stream data lost since the previous trial.
+    """
+    global photodiode_status
+    window = photodiode_stream.get_samples(start, end)
+    status = photodiode_stream.status()
+    lost = {key: status[key] - photodiode_status[key] for key in ('lost_packets', 'skipped_scans', 'overruns')}
+    photodiode_status = status
+    if any(lost.values()) or status['error']:
+        logging.warning(f"Photodiode stream: {lost['lost_packets']} packet(s) lost, "
+                        f"{lost['skipped_scans']} scan(s) skipped, {lost['overruns']} overrun(s) this trial, "
+                        f"error: {status['error']}")
+    metrics = {
+        'photodiode_samples': len(window.times),
+        'photodiode_complete': window.complete,
+        'photodiode_lost_packets': lost['lost_packets'],
+        'photodiode_skipped_scans': lost['skipped_scans'],
+        'photodiode_max_backlog': status['max_backlog'],
+    }
+    # Each flash has to appear before the next item's onset
+    metrics.update(photodiode_onsets.onset_metrics(window.times, window.values[:, 0], item_flips, trigger_timeline,
+                                                   max_lag=item_duration, flip_tolerance=frameDur / 2))
+    if metrics['photodiode_missed_onsets']:
+        logging.warning(f"Photodiode: no flash found for {metrics['photodiode_missed_onsets']} "
+                        f"of {len(item_flips)} item onsets")
+    if metrics['photodiode_latency_mean_ms'] is not None:
+        logging.exp(f"PHOTODIODE: flip to photon {metrics['photodiode_latency_mean_ms']:.2f} ms "
+                    f"(SD {metrics['photodiode_latency_sd_ms'] or 0:.2f}, max {metrics['photodiode_latency_max_ms']:.2f})")
+    return metrics
+
 
 # --- Experiment Setup ---
 exp_info = {
@@ -127,9 +216,10 @@ exp_info = {
     'Hours of computer games this week': '',
     'Viewing Distance (cm)': 300,
     'Test Mode': ('No', 'Yes'),  # Added test mode option
+    'Procedure': ('Fixed', 'Adaptive'),  # Adaptive runs a staircase in the response blocks
 }
 
-dlg = gui.DlgFromDict(dictionary=exp_info, title='Experiment Setup', order=['Participant ID', 'Age','Gender', 'Ethnicity', 'Handedness', 'Vision', 'Glasses/Contacts', 'Eye Dominance', 'Hours of Sleep last night', 'Hours of computer use today', 'Hours of computer games this week', 'Viewing Distance (cm)', 'Test Mode'])
+dlg = gui.DlgFromDict(dictionary=exp_info, title='Experiment Setup', order=['Participant ID', 'Age','Gender', 'Ethnicity', 'Handedness', 'Vision', 'Glasses/Contacts', 'Eye Dominance', 'Hours of Sleep last night', 'Hours of computer use today', 'Hours of computer games this week', 'Viewing Distance (cm)', 'Test Mode', 'Procedure'])
 if not dlg.OK:
     core.quit()
 
@@ -142,9 +232,13 @@ if not os.path.exists(DATA_FOLDER):
 exp = data.ExperimentHandler(name='RSVP_Size', version='1.0',
                              extraInfo=exp_info, runtimeInfo=True,
                              originPath=__file__,
-                             savePickle=True, saveWideText=True,
+                             savePickle=True, saveWideText=False,  # CSV is derived from the trial log
                              dataFileName=filename)
 
+# Each trial is appended here as soon as it ends, so a crash keeps the data
+# collected so far
+trial_writer = trial_log.TrialLogWriter(filename + '_trials.jsonl', fsync_every=TRIAL_LOG_FSYNC_EVERY)
+
 logFile = logging.LogFile(filename + '.log', level=logging.EXP)
 logging.console.setLevel(logging.WARNING)
 
@@ -189,6 +283,10 @@ print(f"Item duration: {ITEM_DURATION_FRAMES} frames ({ITEM_DURATION_FRAMES * fr
 print(f"Practice duration: {PRACTICE_DURATION_FRAMES} frames ({PRACTICE_DURATION_FRAMES * frameDur * 1000:.2f} ms)")
 
 ljack = initialize_labjack()
+if ljack is None:
+    logging.warning("TRIGGER: LabJack not available, no triggers will be sent this session")
+photodiode_stream = initialize_photodiode_stream() if ljack is not None else None
+photodiode_status = photodiode_stream.status() if photodiode_stream is not None else None
 
 
 snellen_font = 'Optician Sans'  # Font for stimuli
@@ -211,8 +309,6 @@ left_eye_no_response_text = visual.TextStim(win=win, text="Left Eye Block - Part
 right_eye_no_response_text = visual.TextStim(win=win, text="Right Eye Block - Part 2\nKeep your LEFT eye covered.\nIn this part, you do NOT need to identify the letter, \nbut you still need to identify the end symbol (- or =).\nPress SPACE or ENTER to begin.", height=0.3, wrapWidth=20)
 switch_to_right_eye_text = visual.TextStim(win=win, text="Left Eye Block Complete\nNow we\\'ll switch to your RIGHT eye.\nPlease take a short break if needed.\nPress SPACE or ENTER when you\\'re ready to continue.", height=0.3, wrapWidth=20)
 fixation_cross = visual.TextStim(win=win, text='+', height=1, font=snellen_font)
-minus_sign = visual.TextStim(win=win, text='-', height=1, font=snellen_font)  # New stimulus for minus sign
-equal_sign = visual.TextStim(win=win, text='=', height=1, font=snellen_font) # New stimulus for equals sign
 response_prompt_text = visual.TextStim(win=win, text="Which letter did you see?\n(Type the letter and press ENTER)", height=0.5, wrapWidth=20)
 typed_response_text = visual.TextStim(win=win, text="", height=1, pos=(0, -2))
 symbol_prompt_text = visual.TextStim(win=win, text="What symbol was shown at the end?\n(- or =)\n(Type - or = and press ENTER)", height=0.5, wrapWidth=20) # Updated prompt for symbol
@@ -220,40 +316,64 @@ typed_symbol_text = visual.TextStim(win=win, text="", height=1.5, pos=(0, -2)) #
 next_trial_text = visual.TextStim(win=win, text="Press SPACE to start the next trial.", height=0.5, wrapWidth=20)
 goodbye_text = visual.TextStim(win=win, text="Thank you for participating!\nThe experiment is now complete.", height=0.5, wrapWidth=25)
 
+END_SYMBOL_HEIGHT = 1  # End symbols are shown at a fixed size, not the trial's stimulus size
 
-rsvp_stim = visual.TextStim(win=win, text='', height=1.0, font=snellen_font) 
-
-# Create photodiode patch stimulus (circular)
+# Create photodiode patch stimuli (circular), one per state so the frame loop
+# never has to change fillColor. Indexed by the compiled photodiode state.
 photodiode_patch = visual.Circle(win=win,
                              radius=PHOTODIODE_SIZE/2,  # Radius is half the size
                              pos=PHOTODIODE_POSITION,
                              fillColor='black',
                              lineColor=None)
+photodiode_patch_on = visual.Circle(win=win,
+                             radius=PHOTODIODE_SIZE/2,
+                             pos=PHOTODIODE_POSITION,
+                             fillColor='white',
+                             lineColor=None)
+photodiode_patches = (photodiode_patch, photodiode_patch_on)
 
 kb = event.BuilderKeyResponse()
+# Background HID reader for typed responses
+response_kb = keyboard.Keyboard()
 
 
 trial_conditions = data.importConditions(CONDITIONS_FILE)
 
-min_size = float('inf')
-max_size = float('-inf')
+if any('logmar' not in condition and 'stimSizeDeg' not in condition for condition in trial_conditions):
+    raise ValueError("Neither 'logmar' nor 'stimSizeDeg' found in conditions file")
 
+# Convert every LogMAR level at once for this monitor, viewing distance and font
+size_table = stimulus_sizes.monitor_size_table(
+    [condition['logmar'] for condition in trial_conditions if 'logmar' in condition], mon, snellen_font)
+degrees_by_logmar = dict(zip(size_table.logmar.tolist(), size_table.degrees.tolist()))
+pixel_height_by_logmar = dict(zip(size_table.logmar.tolist(), size_table.pixel_height.tolist()))
 for condition in trial_conditions:
     if 'logmar' in condition:
-        logmar_value = float(condition['logmar'])
-        condition['stimSizeDeg'] = logmar_to_degrees(logmar_value)
-        
-        min_size = min(min_size, condition['stimSizeDeg'])
-        max_size = max(max_size, condition['stimSizeDeg'])
-        
-        print(f"Converting LogMAR {logmar_value} to {condition['stimSizeDeg']} degrees")
-    elif 'stimSizeDeg' not in condition:
-        raise ValueError("Neither 'logmar' nor 'stimSizeDeg' found in conditions file")
+        condition['stimSizeDeg'] = degrees_by_logmar[float(condition['logmar'])]
 
-print(f"Size range: {min_size} to {max_size} degrees of visual angle")
+sizes = [condition['stimSizeDeg'] for condition in trial_conditions]
+print(f"Size range: {min(sizes)} to {max(sizes)} degrees of visual angle")
+for warning in stimulus_sizes.size_warnings(size_table):
+    print(f"WARNING: {warning}")
+    logging.warning(warning)
 
 trial_conditions = sorted(trial_conditions, key=lambda x: x['stimSizeDeg'], reverse=True)
 
+# Render every stream item at every stimulus size once, so item onsets in the
+# frame loop only switch between ready-made stimuli instead of calling setText
+glyph_cache = GlyphCache(win, font=snellen_font)
+glyph_cache.prerender(DISTRACTORS + TARGET_LETTERS, [condition['stimSizeDeg'] for condition in trial_conditions])
+glyph_cache.prerender(FIXATION_SYMBOLS, [END_SYMBOL_HEIGHT])
+print(f"Pre-rendered {len(glyph_cache)} glyphs")
+
+# LogMAR of each stimulus size, for the adaptive procedure
+logmar_to_size = {float(condition['logmar']) if 'logmar' in condition else float(degrees_to_logmar(condition['stimSizeDeg'])):
+                  condition['stimSizeDeg'] for condition in trial_conditions}
+adaptive_procedure = exp_info['Procedure'] == 'Adaptive'
+if adaptive_procedure:
+    # Computed once per set of conditions and reused by every staircase
+    likelihood_table = load_likelihood_table(list(logmar_to_size), LIKELIHOOD_CACHE_FOLDER, file_hash(CONDITIONS_FILE))
+
 expanded_trial_list = []
 for condition in trial_conditions:
     for _ in range(N_TRIALS_PER_SIZE):
@@ -271,6 +391,20 @@ practice_handler = data.TrialHandler(nReps=1, method='random',
                                      name='practice')
 # Note: Not adding practice_handler to exp since we don't want to log practice data
 
+# Every stream in the session is fixed by RANDOM_SEED, the block, the eye, the
+# stimulus size and the trial number. Participant ID is excluded to ensure
+# consistency across all participants.
+# The adaptive response blocks run up to ADAPTIVE_MAX_TRIALS trials whose
+# sizes come from the staircase, so they need a stream for each of those
+if adaptive_procedure:
+    response_stream_list = [{'stimSizeDeg': None}] * max(ADAPTIVE_MAX_TRIALS, len(expanded_trial_list))
+else:
+    response_stream_list = None
+session_streams, streams_cached = rsvp_streams.load_or_generate_session(
+    SESSION_STREAMS_FILE, expanded_trial_list, practice_trials_list, RANDOM_SEED, STREAM_SPEC,
+    response_list=response_stream_list)
+print(f"{'Loaded' if streams_cached else 'Generated'} session streams ({SESSION_STREAMS_FILE})")
+
 trials_response = data.TrialHandler(nReps=1, method='sequential',
                                    originPath=-1,
                                    trialList=expanded_trial_list,
@@ -281,266 +415,254 @@ trials_no_response = data.TrialHandler(nReps=1, method='sequential',
                                       trialList=expanded_trial_list,
                                       name='trials_no_response')
 
-def show_message(text_stim, wait_keys=['space', 'return', 'enter']):
-    """Displays a TextStim and waits for a key press."""
+def show_message(text_stim, wait_keys=['space', 'return', 'enter'], while_waiting=None):
+    """Displays a TextStim and waits for a key press.
+    while_waiting, if given, is called once the message is on screen."""
     text_stim.draw()
     win.flip()
+    if while_waiting is not None:
+        while_waiting()
     event.waitKeys(keyList=wait_keys)
     win.flip()
 
-def collect_response(prompt_stim, typed_stim, expected_chars_list=None):
+def collect_response(spec, prompt_stim, typed_stim):
     """Collects a typed response until Enter is pressed.
-    Handles mapping of PsychoPy key names to characters for letters, '+', '-', and '='.
-    Correctly interprets Shift + '=' as '+'.
+    spec is a ResponseSpec from RESPONSE_SPECS, which gives the keys to listen
+    for and the character each one types.
+    Waits on the psychtoolbox keyboard queue and only redraws when the typed
+    text changes, so nothing is rendered while the participant is thinking.
+    Returns the response, the flip time of the prompt and a list of
+    (key name, time from prompt onset) for every key handled. The keyboard
+    clock is reset on the prompt's flip, so key.rt is measured from the prompt
+    whatever clock the keyboard backend timestamps keys on.
     """
     response_str = ""
     typed_stim.text = ""
-    # Initial prompt display is now done after setting up listeners
-
-    # PsychoPy key names and their corresponding characters (for direct mapping)
-    # The 'equal' key is handled specially below to check for the Shift modifier.
-    key_name_to_char_map = {
-        'a': 'A', 'b': 'B', 'c': 'C', 'd': 'D', 'e': 'E', 'f': 'F', 'g': 'G',
-        'h': 'H', 'i': 'I', 'j': 'J', 'k': 'K', 'l': 'L', 'm': 'M', 'n': 'N',
-        'o': 'O', 'p': 'P', 'q': 'Q', 'r': 'R', 's': 'S', 't': 'T', 'u': 'U',
-        'v': 'V', 'w': 'W', 'x': 'X', 'y': 'Y', 'z': 'Z',
-        'plus': '+',        # For a dedicated '+' key (e.g., on numpad or some keyboards)
-        'minus': '-',       # For a dedicated '-' key
-        'kp_add': '+',      # Numpad '+'
-        'kp_subtract': '-', # Numpad '-'
-        'kp_equal': '=',    # Numpad '=' (if it exists and is used)
-    }
+    key_times = []
 
-    active_allowed_chars = []
-    # Determine active_allowed_chars based on the prompt type
-    if prompt_stim == symbol_prompt_text: # Symbol prompt
-        # expected_chars_list is ['-', '='] when called for symbol prompt
-        active_allowed_chars = [char.upper() for char in expected_chars_list if char in ['-', '=']] if expected_chars_list else ['-', '=']
-    elif prompt_stim == response_prompt_text: # Letter prompt
-        # expected_chars_list is None when called for letter prompt
-        active_allowed_chars = [chr(ord('A') + i) for i in range(26)] # Default to all uppercase letters
-        if expected_chars_list: # This part is not currently used but allows for future restriction
-            # active_allowed_chars = [char.upper() for char in expected_chars_list if char.isalpha()]
-            pass
-
-
-    # Determine which base key names to listen for
-    base_listen_keys = ['backspace', 'return', 'enter', 'escape']
-    # Check if any uppercase letter A-Z is in active_allowed_chars
-    if any(chr(ord('A') + i) in active_allowed_chars for i in range(26)):
-        for i in range(26):
-            base_listen_keys.append(chr(ord('a') + i)) # Listen for 'a', 'b', ...
-
-    if '-' in active_allowed_chars or '=' in active_allowed_chars:
-        # Add all possible key names that could represent minus or equals
-        base_listen_keys.extend(['equal', 'minus', 'kp_subtract', 'kp_equal', 'num_subtract', 'hyphen', 'dash'])
-
-    listen_for_key_names = list(set(base_listen_keys)) # Ensure unique key names
-
-    # Initial display of prompt
+    # Initial display of prompt; keys pressed before it appeared are discarded
     prompt_stim.draw()
     typed_stim.draw() # Initially empty
-    win.flip()
+    win.callOnFlip(response_kb.clock.reset)
+    prompt_onset = win.flip()
+    response_kb.clearEvents()
 
     break_loop = False
     while not break_loop:
-        # Get all key events in this frame, with modifiers
-        keys_with_mods = event.getKeys(keyList=listen_for_key_names, modifiers=True)
-
-        if not keys_with_mods: 
-            prompt_stim.draw()
-            typed_stim.draw()
-            win.flip()
-            core.wait(0.001) 
-            continue 
-
-        # Process each key event from this frame
-        for key_name_pressed, mods in keys_with_mods:
-            if key_name_pressed in ['escape']:
+        # Key-down events since the last check, timestamped by the keyboard queue
+        keys = response_kb.getKeys(keyList=spec.key_list, waitRelease=False, clear=True)
+
+        if not keys:
+            # Sleep rather than flip; core.wait keeps the window responsive
+            core.wait(RESPONSE_POLL_INTERVAL, hogCPUperiod=0)
+            continue
+
+        # Process each key event since the last check
+        for key in keys:
+            key_name_pressed = key.name
+            if key_name_pressed == response_specs.ESCAPE_KEY:
                 print("User aborted experiment.")
                 core.quit() 
-                return ""  # Should not be reached if core.quit() works
+                return "", prompt_onset, key_times  # Should not be reached if core.quit() works
             
-            elif key_name_pressed in ['return', 'enter']:
+            elif key_name_pressed in response_specs.ENTER_KEYS:
                 if response_str: # Only accept if there's a response
+                    key_times.append((key_name_pressed, key.rt))
                     break_loop = True # Signal to break outer while-loop
-                    break # Exit this inner for-loop (over keys_with_mods)
+                    break # Exit this inner for-loop (over keys)
                 else:
-                    # No response yet, ignore enter, continue processing other keys in this frame if any
+                    # No response yet, ignore enter, continue processing other keys if any
                     continue 
-            
-            elif key_name_pressed == 'backspace':
+
+            elif key_name_pressed == response_specs.BACKSPACE_KEY:
+                key_times.append((key_name_pressed, key.rt))
                 response_str = response_str[:-1]
                 # typed_stim.text will be updated before the flip
             
             else: # Character input keys
-                char_to_add = None
-                is_shift_pressed = mods.get('shift', False)
-
-                if key_name_pressed == 'equal': # Handle '=' key
-                    char_to_add = '='
-                elif key_name_pressed == 'minus' or key_name_pressed == 'hyphen' or key_name_pressed == 'dash' or key_name_pressed == 'num_subtract' or key_name_pressed == 'kp_subtract': # Handle all possible minus key variants
-                    char_to_add = '-'
-                elif key_name_pressed in key_name_to_char_map: # For letters and other mapped keys
-                    char_to_add = key_name_to_char_map[key_name_pressed]
-                
-                if char_to_add and char_to_add in active_allowed_chars:
-                    if prompt_stim == symbol_prompt_text:
+                char_to_add = spec.key_to_char.get(key_name_pressed)
+                if char_to_add:
+                    key_times.append((key_name_pressed, key.rt))
+                    if spec.single_char:
                         # For symbol prompt, overwrite to ensure only one symbol
                         response_str = char_to_add
-                    elif prompt_stim == response_prompt_text: # For letter prompt, append
+                    else: # For letter prompt, append
                         response_str += char_to_add
         
-        # After processing all keys for this frame, update display
-        typed_stim.text = response_str
-        prompt_stim.draw()
-        typed_stim.draw()
-        win.flip()
+        # After processing the keys, redraw only if the typed text changed
+        if not break_loop and typed_stim.text != response_str:
+            typed_stim.text = response_str
+            prompt_stim.draw()
+            typed_stim.draw()
+            win.flip()
 
     # break_loop is true, meaning 'return'/'enter' was pressed with a valid response
     win.flip() # Clear the prompt/response from screen
-    return response_str
-
-def run_rsvp_trial(win, stim_size_deg, item_duration_frames, require_response=True, end_fix_duration=FIXATION_POST_STREAM_RESPONSE_DUR, trial_num=0):
-    # Create a seeded random number generator for this trial
-    # We use only the trial parameters and trial number to create a reproducible seed
-    # Participant ID is excluded to ensure consistency across all participants
-    seed_value = int(hash(str(stim_size_deg) + str(require_response) + str(trial_num)) % 2**32)
-    rng = np.random.RandomState(seed_value)
-    
-    # Use the seeded RNG for all "random" choices
-    target_letter = TARGET_LETTERS[rng.randint(0, len(TARGET_LETTERS))]
-    target_position = rng.randint(TARGET_POS_MIN, TARGET_POS_MAX + 1)  # +1 because randint upper bound is exclusive
-    end_symbol = FIXATION_SYMBOLS[rng.randint(0, len(FIXATION_SYMBOLS))]  # Random - or =
-
-    stream = []
-    for i in range(N_STREAM_ITEMS):
-        if i == target_position:
-            stream.append(target_letter)
-        else:
-            # Choose a distractor that's different from the last item in the stream
-            while True:
-                distractor_idx = rng.randint(0, len(DISTRACTORS))
-                distractor = DISTRACTORS[distractor_idx]
-                if not stream or distractor != stream[-1]:
-                    break
-            stream.append(distractor)
+    return response_str, prompt_onset, key_times
+
+
+def add_response_timing(trial_metrics, prefix, prompt_onset, key_times):
+    """
+    Add the keys and reaction times of one response to trial_metrics.
+    first_key_rt is the first key handled (letter, symbol or backspace) and
+    enter_rt the Enter that accepted the response, both from prompt onset.
+    key_times are the key presses on the win.flip() and trigger clock.
+    """
+    trial_metrics[f'{prefix}_prompt_onset'] = prompt_onset
+    trial_metrics[f'{prefix}_keys'] = [name for name, _ in key_times]
+    trial_metrics[f'{prefix}_key_times'] = [prompt_onset + rt for _, rt in key_times]
+    trial_metrics[f'{prefix}_first_key_rt'] = key_times[0][1] if key_times else None
+    trial_metrics[f'{prefix}_enter_rt'] = key_times[-1][1] if key_times else None
+
+# Triggered stream items, as (offset from target position, log label)
+TRIGGERED_ITEMS = [
+    (-2, "Pre-target -2 stimulus"),   # Will be a number
+    (-1, "Pre-target -1 stimulus"),   # Will be a number
+    (0, "Target Letter Onset"),       # Keeps individual letter codes
+    (1, "Post-target +1 stimulus"),   # Will be a number
+]
+
+# Log label of each stream event; events are recorded by index during the
+# stream and only formatted once it is over
+EVENT_STREAM_START = 0
+EVENT_STREAM_END = len(TRIGGERED_ITEMS) + 1
+EVENT_LABELS = ["RSVP Stream Start"] + [label for _, label in TRIGGERED_ITEMS] + ["RSVP Stream End"]
+trial_events = EventBuffer(EVENT_LABELS)
+
+def compile_rsvp_trial(stream, stim_size_deg, item_duration_frames, target_position):
+    """
+    Build the frame schedule for a stream.
+    Only the items around the target get triggers, to reduce trigger load.
+    Each triggered frame carries an (event_id, item, trigger) tuple for trial_events.
+    """
+    item_triggers = {}
+    item_messages = {}
+    for event_id, (offset, label) in enumerate(TRIGGERED_ITEMS, start=EVENT_STREAM_START + 1):
+        i = target_position + offset
+        if 0 <= i < len(stream):
+            item_triggers[i] = TRIGGER_MAP[stream[i]]
+            item_messages[i] = (event_id, stream[i], TRIGGER_MAP[stream[i]])
+
+    return compile_trial([glyph_cache.get(item, stim_size_deg) for item in stream],
+                         item_duration_frames,
+                         item_triggers=item_triggers,
+                         item_messages=item_messages,
+                         lead_in_stim=fixation_cross,
+                         lead_in_frames=1,
+                         lead_in_trigger=TRIGGER_STREAM_START,
+                         lead_in_message=(EVENT_STREAM_START, fixation_cross.text, TRIGGER_STREAM_START))
+
+def run_rsvp_trial(win, stim_size_deg, item_duration_frames, require_response=True, end_fix_duration=FIXATION_POST_STREAM_RESPONSE_DUR, trial_plan=None):
+    # The target, end symbol and stream come from the pre-generated session
+    target_letter = trial_plan['target_letter']
+    target_position = trial_plan['target_position']
+    end_symbol = trial_plan['end_symbol']
+    stream = trial_plan['stream']
+
+    labjackU3.trigger_log.clear()
+    trial_events.clear()
+    logging.exp(f"RSVP Stream Start - Target at position {target_position}")
 
     # Display fixation cross before the stream
     fixation_cross.draw()
-    # Set photodiode patch to black for the fixation period
-    photodiode_patch.fillColor = 'black'
+    # Photodiode patch stays black for the fixation period
     photodiode_patch.draw()
-    win.flip()
-    core.wait(FIXATION_PRE_STREAM_DUR)    # RSVP stream presentation
-    # Send stream start trigger before any items are displayed
-    send_trigger(ljack, TRIGGER_STREAM_START)
-    logging.exp(f"RSVP Stream Start - Target at position {target_position}")
-      # Wait one frame to ensure stream start trigger is processed before item triggers
-    for frame in range(1):
-        fixation_cross.draw()
-        photodiode_patch.fillColor = 'black'
-        photodiode_patch.draw()
-        win.flip()
-    
-    for i, item in enumerate(stream):
-        rsvp_stim.setText(item)
-        rsvp_stim.height = stim_size_deg
-        for frame in range(item_duration_frames):
-            if frame == 0:
-                # Send triggers for pre-target items, target, and post-target item
-                if i == target_position - 2:
-                    # Send trigger for pre-target -2 stimulus (will be a number)
-                    send_trigger(ljack, TRIGGER_MAP[item])
-                    logging.exp(f"Pre-target -2 stimulus - Item: {item}, Trigger: {TRIGGER_MAP[item]}")
-                elif i == target_position - 1:
-                    # Send trigger for pre-target -1 stimulus (will be a number)
-                    send_trigger(ljack, TRIGGER_MAP[item])
-                    logging.exp(f"Pre-target -1 stimulus - Item: {item}, Trigger: {TRIGGER_MAP[item]}")
-                elif i == target_position:
-                    # Send target-specific trigger (maintains individual letter codes)
-                    send_trigger(ljack, TRIGGER_MAP[item])
-                    logging.exp(f"Target Letter Onset - Item: {item}, Trigger: {TRIGGER_MAP[item]}")
-                elif i == target_position + 1:
-                    # Send trigger for post-target +1 stimulus (will be a number)
-                    send_trigger(ljack, TRIGGER_MAP[item])
-                    logging.exp(f"Post-target +1 stimulus - Item: {item}, Trigger: {TRIGGER_MAP[item]}")
-                # No triggers for other distractor items to reduce trigger load
-                
-                # Set photodiode patch to white at the onset of each stimulus
-                photodiode_patch.fillColor = 'white'
-            
-            # Draw stimulus and photodiode patch
-            rsvp_stim.draw()
-            photodiode_patch.draw()
-            win.flip()
-            
-            # Set photodiode patch back to black after the first frame
-            if frame == 0:
-                photodiode_patch.fillColor = 'black'
+    fixation_onset = win.flip()
+
+    # Compile the stream into a frame schedule while the fixation cross is up,
+    # then wait out whatever is left of the fixation period
+    compiled = compile_rsvp_trial(stream, stim_size_deg, item_duration_frames, target_position)
+    # win.flip() timestamps are on core.monotonicClock, so measure the elapsed time there
+    core.wait(max(0.0, FIXATION_PRE_STREAM_DUR - (core.monotonicClock.getTime() - fixation_onset)))
+
+    # Timestamp of every flip in the stream, plus the flip that shows the end symbol
+    flip_times = np.empty(compiled.n_frames + 1)
+
+    # RSVP stream presentation. The first frame repeats the fixation cross and
+    # carries the stream start trigger, so it is processed before item triggers.
+    for frame in range(compiled.n_frames):
+        trigger_value = compiled.triggers[frame]
+        if trigger_value:
+            send_trigger(ljack, int(trigger_value))
+        frame_event = compiled.messages.get(frame)
+        if frame_event is not None:
+            trial_events.record(frame, *frame_event)
+
+        compiled.stims[compiled.stim_ids[frame]].draw()
+        photodiode_patches[compiled.photodiode[frame]].draw()
+        flip_times[frame] = win.flip()
 
     # Display the end symbol (- or =)
-    if end_symbol == '-':
-        minus_sign.draw()
-    else:
-        equal_sign.draw()
+    glyph_cache.get(end_symbol, END_SYMBOL_HEIGHT).draw()
     
-    # Set photodiode patch to black for the end symbol period
-    photodiode_patch.fillColor = 'black'
+    # Photodiode patch is black for the end symbol period
     photodiode_patch.draw()
     
     send_trigger(ljack, TRIGGER_STREAM_END)
-    logging.exp(f"RSVP Stream End - End symbol: {end_symbol}") # Log the chosen end symbol
+    trial_events.record(compiled.n_frames, EVENT_STREAM_END, end_symbol, TRIGGER_STREAM_END)
     
-    win.flip()
+    flip_times[-1] = win.flip()
+
+    # Check that ITEM_DURATION_FRAMES was actually honoured
+    target_onset_frame = compiled.item_onsets[target_position]
+    trial_metrics = frame_timing(flip_times, frameDur, target_onset_frame, target_onset_frame + item_duration_frames)
+    if trial_metrics['frame_dropped_count']:
+        logging.warning(f"Dropped {trial_metrics['frame_dropped_count']} frame(s) during stream, "
+                        f"target shown for {trial_metrics['target_duration_ms']:.1f} ms")
+
     core.wait(end_fix_duration) # Display the end symbol for the specified duration
     win.flip() # Clear the screen
 
+    # Write out the stream events, timestamped with the flips they were shown on
+    trial_events.stamp(flip_times)
+    trial_events.dump(logging.exp)
+
+    # Every trigger of the trial has been written by now
+    trigger_timeline = labjackU3.trigger_log.entries()
+    log_trigger_timeline(trigger_timeline)
+    trial_metrics['trigger_codes'] = trigger_timeline['code'].tolist()
+    trial_metrics['trigger_flip_times'] = trigger_timeline['flip'].tolist()
+    trial_metrics['trigger_write_start_times'] = trigger_timeline['sent'].tolist()
+    # In pulse mode the write returns once the card has finished the pulse
+    trial_metrics['trigger_write_done_times'] = trigger_timeline['completed'].tolist()
+
+    # The stream has caught up with the end symbol flip during the end fixation
+    if photodiode_stream is not None:
+        trial_metrics.update(photodiode_trial_metrics(fixation_onset, flip_times[-1] + frameDur,
+                                                      flip_times[compiled.item_onsets], trigger_timeline,
+                                                      item_duration_frames * frameDur))
+
     letter_response = None
     letter_accuracy = None
     symbol_response = None
     symbol_accuracy = None
 
     if require_response:
-        letter_response = collect_response(response_prompt_text, typed_response_text, expected_chars_list=None) # Defaults to A-Z
+        letter_response, letter_prompt_onset, letter_key_times = collect_response(RESPONSE_SPECS['letter'], response_prompt_text, typed_response_text)
         letter_accuracy = 1 if letter_response == target_letter else 0
+        add_response_timing(trial_metrics, 'letter', letter_prompt_onset, letter_key_times)
     else:
         letter_response = 'N/A'
         letter_accuracy = 'N/A'    # Always collect symbol response
-    symbol_response = collect_response(symbol_prompt_text, typed_symbol_text, expected_chars_list=['-', '='])
+    symbol_response, symbol_prompt_onset, symbol_key_times = collect_response(RESPONSE_SPECS['symbol'], symbol_prompt_text, typed_symbol_text)
     symbol_accuracy = 1 if symbol_response == end_symbol else 0
+    add_response_timing(trial_metrics, 'symbol', symbol_prompt_onset, symbol_key_times)
 
     # Extract pre-target and post-target stimuli for data logging
     pre_target_2 = stream[target_position - 2] if target_position >= 2 else 'N/A'
     pre_target_1 = stream[target_position - 1] if target_position >= 1 else 'N/A'
     post_target_1 = stream[target_position + 1] if target_position + 1 < len(stream) else 'N/A'
 
-    return target_letter, target_position, stream, letter_response, letter_accuracy, end_symbol, symbol_response, symbol_accuracy, pre_target_2, pre_target_1, post_target_1
+    return target_letter, target_position, stream, letter_response, letter_accuracy, end_symbol, symbol_response, symbol_accuracy, pre_target_2, pre_target_1, post_target_1, trial_metrics
 
-def run_practice_trial(win, stim_size_deg, item_duration_frames, require_response=True, end_fix_duration=FIXATION_POST_STREAM_RESPONSE_DUR, trial_num=0):
+def run_practice_trial(win, stim_size_deg, item_duration_frames, require_response=True, end_fix_duration=FIXATION_POST_STREAM_RESPONSE_DUR, trial_plan=None):
     """
     Simplified RSVP trial for practice - no photodiode flashes, triggers, or detailed logging.
     """
-    # Create a seeded random number generator for this trial
-    seed_value = int(hash(str(stim_size_deg) + str(require_response) + str(trial_num)) % 2**32)
-    rng = np.random.RandomState(seed_value)
-    
-    # Use the seeded RNG for all "random" choices
-    target_letter = TARGET_LETTERS[rng.randint(0, len(TARGET_LETTERS))]
-    target_position = rng.randint(TARGET_POS_MIN, TARGET_POS_MAX + 1)
-    end_symbol = FIXATION_SYMBOLS[rng.randint(0, len(FIXATION_SYMBOLS))]
-
-    stream = []
-    for i in range(N_STREAM_ITEMS):
-        if i == target_position:
-            stream.append(target_letter)
-        else:
-            while True:
-                distractor_idx = rng.randint(0, len(DISTRACTORS))
-                distractor = DISTRACTORS[distractor_idx]
-                if not stream or distractor != stream[-1]:
-                    break
-            stream.append(distractor)
+    target_letter = trial_plan['target_letter']
+    target_position = trial_plan['target_position']
+    end_symbol = trial_plan['end_symbol']
+    stream = trial_plan['stream']
 
     # Display fixation cross before the stream (no photodiode)
     fixation_cross.draw()
@@ -549,18 +671,14 @@ def run_practice_trial(win, stim_size_deg, item_duration_frames, require_respons
     
     # RSVP stream presentation (no triggers or photodiode)
     for i, item in enumerate(stream):
-        rsvp_stim.setText(item)
-        rsvp_stim.height = stim_size_deg
+        item_stim = glyph_cache.get(item, stim_size_deg)
         for frame in range(item_duration_frames):
             # Just draw the stimulus (no photodiode or triggers)
-            rsvp_stim.draw()
+            item_stim.draw()
             win.flip()
 
     # Display the end symbol (no photodiode)
-    if end_symbol == '-':
-        minus_sign.draw()
-    else:
-        equal_sign.draw()
+    glyph_cache.get(end_symbol, END_SYMBOL_HEIGHT).draw()
     
     win.flip()
     core.wait(end_fix_duration)
@@ -572,13 +690,13 @@ def run_practice_trial(win, stim_size_deg, item_duration_frames, require_respons
     symbol_accuracy = None
 
     if require_response:
-        letter_response = collect_response(response_prompt_text, typed_response_text, expected_chars_list=None)
+        letter_response, _, _ = collect_response(RESPONSE_SPECS['letter'], response_prompt_text, typed_response_text)
         letter_accuracy = 1 if letter_response == target_letter else 0
     else:
         letter_response = 'N/A'
         letter_accuracy = 'N/A'
       # Always collect symbol response
-    symbol_response = collect_response(symbol_prompt_text, typed_symbol_text, expected_chars_list=['-', '='])
+    symbol_response, _, _ = collect_response(RESPONSE_SPECS['symbol'], symbol_prompt_text, typed_symbol_text)
     symbol_accuracy = 1 if symbol_response == end_symbol else 0
 
     # Extract pre-target and post-target stimuli for consistency
@@ -599,16 +717,15 @@ def run_font_size_test_mode(win):
     test_stim = visual.TextStim(win=win, text='R', height=1.0, font=snellen_font)  # Using 'A' as a standard test letter
     size_info_text = visual.TextStim(win=win, text='', pos=(0, -3), height=0.5, wrapWidth=20.5)
     
-    # Sort conditions from largest to smallest size
-    sorted_conditions = sorted(trial_conditions, key=lambda x: x['stimSizeDeg'], reverse=True)
-    
-    for condition in sorted_conditions:
+    # trial_conditions is already sorted from largest to smallest size
+    for condition in trial_conditions:
         stim_size = condition['stimSizeDeg']
         logmar = condition.get('logmar', 'N/A')
+        pixel_height = pixel_height_by_logmar.get(float(logmar), 'N/A') if logmar != 'N/A' else 'N/A'
         
         # Display the letter at this size
         test_stim.height = stim_size
-        size_info_text.text = f"Size: {stim_size:.4f} degrees (LogMAR: {logmar})"
+        size_info_text.text = f"Size: {stim_size:.4f} degrees, {pixel_height} px (LogMAR: {logmar})"
         
         test_stim.draw()
         size_info_text.draw()
@@ -640,10 +757,13 @@ if exp_info['Test Mode'] == 'Yes':
     core.wait(2.0)
     
     # Clean up and exit
+    if photodiode_stream is not None:
+        photodiode_stream.stop()
     if ljack is not None:
-        labjackU3.trigger(0)  # Reset the trigger to 0
+        labjackU3.close()  # Send any queued triggers and leave the port at 0
         logging.exp("LabJack reset at experiment end")
     
+    trial_writer.close()
     win.close()
     core.quit()
 else:
@@ -662,7 +782,7 @@ else:
                                              item_duration_frames=PRACTICE_DURATION_FRAMES,
                                              require_response=True,
                                              end_fix_duration=FIXATION_POST_STREAM_RESPONSE_DUR,
-                                             trial_num=trial_num_practice)
+                                             trial_plan=session_streams['blocks']['practice'][trial_num_practice])
 
         # No data logging for practice trials - just provide feedback
         print(f"Practice trial {trial_num_practice + 1}: Target='{target}', Response='{l_resp}', Correct={l_acc}")
@@ -679,10 +799,19 @@ else:
             show_message(right_eye_instruction_text)
             block_prefix = 'right_eye'
 
-        trials_response = data.TrialHandler(nReps=1, method='sequential',
-                                            originPath=-1,
-                                            trialList=expanded_trial_list,
-                                            name='trials_response')
+        if adaptive_procedure:
+            # Sizes come from the staircase, so the loop only counts trials
+            staircase = BayesianStaircase(list(logmar_to_size), table=likelihood_table, max_sd=ADAPTIVE_MAX_SD,
+                                          min_trials=ADAPTIVE_MIN_TRIALS, max_trials=ADAPTIVE_MAX_TRIALS)
+            trials_response = data.TrialHandler(nReps=ADAPTIVE_MAX_TRIALS, method='sequential',
+                                                originPath=-1,
+                                                trialList=None,
+                                                name='trials_response')
+        else:
+            trials_response = data.TrialHandler(nReps=1, method='sequential',
+                                                originPath=-1,
+                                                trialList=expanded_trial_list,
+                                                name='trials_response')
         
         trials_no_response = data.TrialHandler(nReps=1, method='sequential',
                                               originPath=-1,
@@ -692,14 +821,18 @@ else:
         exp.addLoop(trials_response)
         for trial_num_block, trial_data in enumerate(trials_response):
             current_trial_global += 1
-            stim_size = trial_data['stimSizeDeg']
-            target, pos, stream_items, l_resp, l_acc, e_sym, s_resp, s_acc, pre_t2, pre_t1, post_t1 = run_rsvp_trial(
+            if adaptive_procedure:
+                logmar = staircase.next_level()
+                stim_size = logmar_to_size[logmar]
+            else:
+                stim_size = trial_data['stimSizeDeg']
+            target, pos, stream_items, l_resp, l_acc, e_sym, s_resp, s_acc, pre_t2, pre_t1, post_t1, trial_metrics = run_rsvp_trial(
                 win,
                 stim_size_deg=stim_size,
                 item_duration_frames=ITEM_DURATION_FRAMES,
                 require_response=True,
                 end_fix_duration=FIXATION_POST_STREAM_RESPONSE_DUR,
-                trial_num=trial_num_block + 1
+                trial_plan=session_streams['blocks'][rsvp_streams.block_name(eye, 'response')][trial_num_block]
             )
 
             trials_response.addData('block_type', f'{block_prefix}_response')
@@ -716,12 +849,30 @@ else:
             trials_response.addData('pre_target_2', pre_t2)
             trials_response.addData('pre_target_1', pre_t1)
             trials_response.addData('post_target_1', post_t1)
+            for key, value in trial_metrics.items():
+                trials_response.addData(key, value)
+            if adaptive_procedure:
+                staircase.update(logmar, l_acc)
+                trials_response.addData('logmar', logmar)
+                trials_response.addData('adaptive_threshold_mean', staircase.mean())
+                trials_response.addData('adaptive_threshold_sd', staircase.sd())
+                block_finished = staircase.finished()
+            else:
+                block_finished = trial_num_block == n_total_trials_per_block - 1
             exp.nextEntry()
+            trial_writer.append(exp.entries[-1])
 
-            if trial_num_block < n_total_trials_per_block - 1:
-                show_message(next_trial_text, wait_keys=['space'])
+            if not block_finished:
+                show_message(next_trial_text, wait_keys=['space'], while_waiting=trial_writer.sync)
             else:
+                trial_writer.sync(force=True) # End of block
                 core.wait(1.0)
+                break
+
+        exp.loopEnded(trials_response)  # The loop is left with break, so end it here
+        if adaptive_procedure:
+            print(f"{eye.capitalize()} eye threshold: {staircase.mean():.3f} LogMAR "
+                  f"(SD {staircase.sd():.3f}) after {len(staircase.history)} trials")
 
         if eye == 'left':
             show_message(left_eye_no_response_text)
@@ -733,13 +884,13 @@ else:
         for trial_num_block, trial_data in enumerate(trials_no_response):
             current_trial_global += 1
             stim_size = trial_data['stimSizeDeg']
-            target, pos, stream_items, l_resp, l_acc, e_sym, s_resp, s_acc, pre_t2, pre_t1, post_t1 = run_rsvp_trial(
+            target, pos, stream_items, l_resp, l_acc, e_sym, s_resp, s_acc, pre_t2, pre_t1, post_t1, trial_metrics = run_rsvp_trial(
                 win,
                 stim_size_deg=stim_size,
                 item_duration_frames=ITEM_DURATION_FRAMES,
                 require_response=False, # Letter response not required
                 end_fix_duration=FIXATION_POST_STREAM_NO_RESPONSE_DUR,
-                trial_num=trial_num_block + 1
+                trial_plan=session_streams['blocks'][rsvp_streams.block_name(eye, 'no_response')][trial_num_block]
             )
 
             trials_no_response.addData('block_type', f'{block_prefix}_no_response')
@@ -756,11 +907,15 @@ else:
             trials_no_response.addData('pre_target_2', pre_t2)
             trials_no_response.addData('pre_target_1', pre_t1)
             trials_no_response.addData('post_target_1', post_t1)
+            for key, value in trial_metrics.items():
+                trials_no_response.addData(key, value)
             exp.nextEntry()
+            trial_writer.append(exp.entries[-1])
 
             if trial_num_block < n_total_trials_per_block - 1:
-                show_message(next_trial_text, wait_keys=['space'])
+                show_message(next_trial_text, wait_keys=['space'], while_waiting=trial_writer.sync)
             else:
+                trial_writer.sync(force=True) # End of block
                 core.wait(0.5) # Wait a bit after the last trial of the no-response block
 
         if eye == 'left':
@@ -771,12 +926,23 @@ goodbye_text.draw()
 win.flip()
 core.wait(3.0)
 
-exp.saveAsWideText(filename + '.csv')
+trial_writer.close()
+n_logged_trials = trial_log.write_csv(trial_writer.path, filename + '.csv')
+print(f"Saved {n_logged_trials} trials to {filename}.csv")
+n_exported_trials = session_export.export_session(trial_writer.path, PARQUET_DATASET_FOLDER,
+                                                  exp_info['Participant ID'], os.path.basename(filename))
+if n_exported_trials is None:
+    print("pyarrow is not installed, skipping the Parquet export")
+else:
+    print(f"Exported {n_exported_trials} trials to {PARQUET_DATASET_FOLDER}")
 exp.saveAsPickle(filename + '.psydat')
 logging.flush()
 
+if photodiode_stream is not None:
+    photodiode_stream.stop()
+    logging.exp(f"Photodiode stream at experiment end: {photodiode_stream.status()}")
 if ljack is not None:
-    labjackU3.trigger(0)  # Reset the trigger to 0
+    labjackU3.close()  # Send any queued triggers and leave the port at 0
     logging.exp("LabJack reset at experiment end")
 
 win.close()
@@ -0,0 +1,191 @@
+"""
+Deterministic stream generation for the RSVP experiments.
+
+Streams for a whole block are drawn in one shot by generate_streams(), a
+vectorised generator that builds the target, its position, the end symbol
+and the no-immediate-repeat distractor sequence as NumPy arrays. Blocks are
+seeded from a numpy SeedSequence keyed on the experiment seed, block and eye,
+so the same block gets the same streams on every launch, station and
+participant. A whole session can be generated ahead of time and cached to
+disk as JSON.
+"""
+
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+
+# Alphabets and stream layout used to generate trials
+StreamSpec = namedtuple('StreamSpec', ['target_letters', 'distractors', 'end_symbols',
+                                       'n_items', 'target_pos_min', 'target_pos_max'])
+
+# Streams for n trials: streams is an (n, n_items) array of symbols, the
+# other fields have one entry per trial
+StreamBatch = namedtuple('StreamBatch', ['streams', 'target_positions', 'target_letters', 'end_symbols'])
+
+# Position of each block and eye in the seed key. Only append to these, as
+# reordering them changes every stream.
+BLOCKS = ('practice', 'response', 'no_response')
+EYES = ('none', 'left', 'right')
+
+# Bump whenever a change to the generator alters the streams it produces, so
+# cached sessions made by an older generator are regenerated
+GENERATOR_VERSION = 1
+
+
+def block_seed_sequence(base_seed, block, eye='none'):
+    """
+    Build the SeedSequence for a block.
+
+    Unlike hash(), which Python salts per process, this gives the same seed
+    in every process.
+    """
+    return np.random.SeedSequence([base_seed, BLOCKS.index(block), EYES.index(eye)])
+
+
+def generate_streams(rng, n_trials, spec):
+    """
+    Draw the streams for n_trials trials at once.
+
+    Each distractor is the previous one plus a step of 1 to n-1 (mod n), which
+    is uniform over every distractor except the previous one, so no distractor
+    is immediately repeated without a rejection loop. The first item and the
+    item after the target are unconstrained and get a step over all n values.
+
+    Args:
+        rng (np.random.Generator): Generator to draw from
+        n_trials (int): Number of streams to generate
+        spec (StreamSpec): Alphabets and stream layout
+
+    Returns:
+        StreamBatch: The streams, target positions, target letters and end symbols
+    """
+    n_items = spec.n_items
+    n_distractors = len(spec.distractors)
+    rows = np.arange(n_trials)
+
+    target_idx = rng.integers(len(spec.target_letters), size=n_trials)
+    target_positions = rng.integers(spec.target_pos_min, spec.target_pos_max + 1, size=n_trials)
+    end_idx = rng.integers(len(spec.end_symbols), size=n_trials)
+
+    steps = rng.integers(1, n_distractors, size=(n_trials, n_items))
+    free_steps = rng.integers(n_distractors, size=(n_trials, 2))
+    steps[:, 0] = free_steps[:, 0]
+    after_target = target_positions + 1
+    has_after = after_target < n_items
+    steps[rows[has_after], after_target[has_after]] = free_steps[has_after, 1]
+    # The target slot carries the previous distractor forward unchanged
+    steps[rows, target_positions] = 0
+    codes = np.cumsum(steps, axis=1) % n_distractors
+
+    # Distractors take codes 0..n-1 in the alphabet, target letters follow them
+    codes[rows, target_positions] = n_distractors + target_idx
+    alphabet = np.array(list(spec.distractors) + list(spec.target_letters))
+
+    return StreamBatch(streams=alphabet[codes],
+                       target_positions=target_positions,
+                       target_letters=np.array(spec.target_letters)[target_idx],
+                       end_symbols=np.array(spec.end_symbols)[end_idx])
+
+
+def block_name(eye, block):
+    """Key of a block in a generated session."""
+    return block if eye == 'none' else f"{eye}_{block}"
+
+
+def generate_block(trial_list, rng, spec):
+    """
+    Generate every trial of a block.
+
+    Args:
+        trial_list (list): Conditions for the block, each with 'stimSizeDeg'
+        rng (np.random.Generator): Generator for the block
+        spec (StreamSpec): Alphabets and stream layout
+
+    Returns:
+        list: One dict per condition with target_letter, target_position,
+              end_symbol, stream and stimSizeDeg
+    """
+    batch = generate_streams(rng, len(trial_list), spec)
+    return [{'target_letter': target_letter,
+             'target_position': target_position,
+             'end_symbol': end_symbol,
+             'stream': stream,
+             'stimSizeDeg': condition['stimSizeDeg']}
+            for condition, target_letter, target_position, end_symbol, stream
+            in zip(trial_list, batch.target_letters.tolist(), batch.target_positions.tolist(),
+                   batch.end_symbols.tolist(), batch.streams.tolist())]
+
+
+def generate_session(trial_list, practice_list, base_seed, spec, response_list=None):
+    """
+    Generate the streams for a whole session ahead of time.
+
+    Args:
+        trial_list (list): Conditions for each main block part
+        practice_list (list): Conditions for the practice trials
+        base_seed (int): Experiment-wide seed
+        spec (StreamSpec): Alphabets and stream layout
+        response_list (list): Conditions for the response blocks if they differ
+            from trial_list, e.g. one per trial of an adaptive procedure
+
+    Returns:
+        dict: The seed, the spec and the trials of each block keyed by block_name()
+    """
+    def block_rng(block, eye='none'):
+        return np.random.default_rng(block_seed_sequence(base_seed, block, eye))
+
+    block_lists = _block_lists(trial_list, response_list)
+    blocks = {'practice': generate_block(practice_list, block_rng('practice'), spec)}
+    for eye in ('left', 'right'):
+        for block in ('response', 'no_response'):
+            blocks[block_name(eye, block)] = generate_block(block_lists[block], block_rng(block, eye), spec)
+
+    return {
+        'generator_version': GENERATOR_VERSION,
+        'seed': base_seed,
+        'spec': spec._asdict(),
+        'blocks': blocks,
+    }
+
+
+def _block_lists(trial_list, response_list):
+    """Conditions of each main block part."""
+    return {'response': trial_list if response_list is None else response_list,
+            'no_response': trial_list}
+
+
+def _matches(session, trial_list, practice_list, base_seed, spec, response_list=None):
+    """Check that a cached session was generated for this design."""
+    if session.get('generator_version') != GENERATOR_VERSION or session.get('seed') != base_seed or session.get('spec') != json.loads(json.dumps(spec._asdict())):
+        return False
+    block_lists = _block_lists(trial_list, response_list)
+    expected_sizes = {'practice': [c['stimSizeDeg'] for c in practice_list]}
+    for eye in ('left', 'right'):
+        for block in ('response', 'no_response'):
+            expected_sizes[block_name(eye, block)] = [c['stimSizeDeg'] for c in block_lists[block]]
+    blocks = session.get('blocks', {})
+    return all(name in blocks and [t['stimSizeDeg'] for t in blocks[name]] == sizes
+               for name, sizes in expected_sizes.items())
+
+
+def load_or_generate_session(path, trial_list, practice_list, base_seed, spec, response_list=None):
+    """
+    Load a session's streams from path, generating and saving them first if
+    the file does not exist or was generated for a different design.
+    response_list is passed on to generate_session().
+
+    Returns:
+        tuple: (session dict, True if the session was loaded from path)
+    """
+    if os.path.exists(path):
+        with open(path) as f:
+            session = json.load(f)
+        if _matches(session, trial_list, practice_list, base_seed, spec, response_list):
+            return session, True
+
+    session = generate_session(trial_list, practice_list, base_seed, spec, response_list)
+    with open(path, 'w') as f:
+        json.dump(session, f)
+    return session, False
@@ -0,0 +1,173 @@
+"""
+Functions to send triggers over a serial port.
+
+Before using triggers, you need to open the port: configure(port_name, baud_rate).
+You can send trigger using trigger(value) function and release the port
+with close() when you are done.
+
+Writes happen on a single writer thread started by configure(). trigger()
+only puts a (value, onset, log slot) job on its queue and returns straight
+away. The writer sends the value from a preallocated one-byte buffer,
+flushes it, and sends 0 once PULSE_WIDTH has passed. A trigger that arrives
+before the previous one was cleared replaces it and moves the clear.
+
+Every trigger is recorded in trigger_log with the time it was requested and
+when the write started and returned. Nothing is formatted or logged while
+triggering; call dump_log() after the trial to write the entries out.
+
+Trigger 0 is used to clear the previous trigger, so it cannot be sent as a
+meaningful value.
+"""
+
+import queue
+import threading
+from time import sleep, perf_counter
+
+import serial
+
+from trigger_log import TriggerLog
+
+#time before sending 0 after a trigger
+PULSE_WIDTH = 0.010
+
+#wait for each byte to leave the output buffer before timestamping the write
+FLUSH = True
+
+#clock used for onsets and for the timestamps in trigger_log
+clock = perf_counter
+
+#timestamps of recent triggers
+trigger_log = TriggerLog()
+
+port = None
+
+#queue of (value, onset, log slot) jobs for the writer thread, None stops it
+_jobs = None
+_writer = None
+
+
+def configure(port_name, baud_rate):
+    """Opens the serial port, sends 0 and starts the writer thread.
+       Returns the serial.Serial object"""
+
+    global port
+    port = serial.Serial(port=port_name, baudrate=baud_rate)
+    port.write(bytes([0]))
+    start_writer()
+    return port
+
+
+def start_writer():
+    """Starts the writer thread for port.
+       This function is started by configure()"""
+
+    global _jobs, _writer
+    _jobs = queue.SimpleQueue()
+    _writer = threading.Thread(target=writer_worker, name="serial-trigger-writer", daemon=True)
+    _writer.start()
+
+
+def close():
+    """Stops the writer once every queued trigger has been sent and
+       cleared, then closes the port."""
+
+    global port, _jobs, _writer
+    if _writer is not None:
+        _jobs.put(None)
+        _writer.join()
+    if port is not None:
+        port.close()
+    port = None
+    _jobs = None
+    _writer = None
+
+
+def wait_until(deadline):
+    """Sleeps until clock() reaches deadline."""
+
+    delay = deadline - clock()
+    if delay > 0:
+        sleep(delay)
+
+
+def writer_worker():
+    """Sends queued triggers and clears each one when PULSE_WIDTH is over.
+       This function is started by configure()"""
+
+    buffer = bytearray(1)
+    clear = bytes([0])
+
+    def write(data):
+        try:
+            port.write(data)
+            if FLUSH:
+                port.flush()
+        except serial.SerialException as _:
+            print("SERIAL ERROR. Trigger " + str(data[0]) + " was not sent!")
+
+    clear_at = None
+    while True:
+        timeout = None if clear_at is None else max(0.0, clear_at - clock())
+        try:
+            job = _jobs.get(timeout = timeout)
+        except queue.Empty:
+            #no new trigger arrived before the pending clear was due
+            write(clear)
+            clear_at = None
+            continue
+
+        if job is None:
+            break
+
+        value, onset, slot = job
+        if clear_at is not None and clear_at <= onset:
+            wait_until(clear_at)
+            write(clear)
+            clear_at = None
+        wait_until(onset)
+        buffer[0] = value
+        trigger_log.mark(slot, 'sent', clock())
+        write(buffer)
+        trigger_log.mark(slot, 'completed', clock())
+        clear_at = clock() + PULSE_WIDTH
+
+    if clear_at is not None:
+        wait_until(clear_at)
+        write(clear)
+
+
+def trigger(value, onset = None, flip_time = float('nan')):
+    """Queues a trigger for the writer. Parameters:
+       value: 1-255
+       onset: clock() time to send it at (default: now)
+       flip_time: timestamp of the flip this trigger marks, for trigger_log
+       Returns 0 if the trigger was queued"""
+
+    value = int(value)
+
+    #check input:
+    error = 0
+    if value<=0 or value > 255 :
+        error = 1001
+    if _jobs is None :
+        error = 1002
+    if error != 0 :
+        return error
+
+    #queue trigger:
+    now = clock()
+    if onset is None:
+        onset = now
+    slot = trigger_log.add(value, now, flip_time)
+    _jobs.put( (value, onset, slot) )
+    return 0
+
+
+def dump_log(log_function):
+    """Passes one line per logged trigger to log_function (e.g. logging.exp),
+       then clears trigger_log. Call between trials, not during a stream."""
+
+    for entry in trigger_log.entries():
+        log_function("TRIGGER: Sent value %d to serial port (flip %.5f, requested %.5f, write start %.5f, write done %.5f)"
+                     % (entry['code'], entry['flip'], entry['requested'], entry['sent'], entry['completed']))
+    trigger_log.clear()
@@ -0,0 +1,162 @@
+"""
+Columnar (Parquet) export of session data.
+
+The trials in a session's trial log are written to a Parquet dataset shared by
+the whole study, partitioned by participant and eye
+(<root>/participant=<id>/eye=<eye>/<session>-0.parquet). Stream items, the
+trigger timeline and the response keys are stored as typed list columns, so
+analysis can read just the columns it needs across every participant with
+pyarrow.dataset or pandas.read_parquet.
+
+pyarrow is optional: without it PARQUET_AVAILABLE is False and
+export_session() does nothing.
+"""
+
+from trial_log import read_trial_log
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+PARTITION_COLUMNS = ['participant', 'eye']
+
+
+def _column_types():
+    """
+    Arrow type of each trial column the experiment scripts write. Every
+    session is written with these types, so the dataset reads as one table
+    even when a session has no value at all for a column. Other columns
+    (PsychoPy's loop bookkeeping and the session info) are inferred.
+    """
+    times = pa.list_(pa.float64())
+    text = pa.string()
+    return {
+        'block_type': text,
+        'trial_num_block': pa.int32(),
+        'trial_num_global': pa.int32(),
+        'target_letter': text,
+        'target_position': pa.int32(),
+        'stim_size_deg': pa.float64(),
+        'letter_response': text,
+        'letter_accuracy': pa.int8(),
+        'end_symbol': text,
+        'symbol_response': text,
+        'symbol_accuracy': pa.int8(),
+        'pre_target_2': text,
+        'pre_target_1': text,
+        'post_target_1': text,
+        'stream': pa.list_(text),
+        'frame_max_interval_ms': pa.float64(),
+        'frame_dropped_count': pa.int32(),
+        'target_duration_ms': pa.float64(),
+        'trigger_codes': pa.list_(pa.uint8()),
+        'trigger_flip_times': times,
+        'trigger_write_start_times': times,
+        'trigger_write_done_times': times,
+        'photodiode_samples': pa.int64(),
+        'photodiode_complete': pa.bool_(),
+        'photodiode_lost_packets': pa.int64(),
+        'photodiode_skipped_scans': pa.int64(),
+        'photodiode_max_backlog': pa.int32(),
+        'photodiode_onset_count': pa.int32(),
+        'photodiode_missed_onsets': pa.int32(),
+        'photodiode_extra_onsets': pa.int32(),
+        'photodiode_latencies_ms': times,
+        'photodiode_latency_mean_ms': pa.float64(),
+        'photodiode_latency_sd_ms': pa.float64(),
+        'photodiode_latency_max_ms': pa.float64(),
+        'trigger_to_photon_ms': times,
+        'trigger_to_photon_mean_ms': pa.float64(),
+        'trigger_to_photon_sd_ms': pa.float64(),
+        'trigger_to_photon_max_ms': pa.float64(),
+        'letter_prompt_onset': pa.float64(),
+        'letter_keys': pa.list_(text),
+        'letter_key_times': times,
+        'letter_first_key_rt': pa.float64(),
+        'letter_enter_rt': pa.float64(),
+        'symbol_prompt_onset': pa.float64(),
+        'symbol_keys': pa.list_(text),
+        'symbol_key_times': times,
+        'symbol_first_key_rt': pa.float64(),
+        'symbol_enter_rt': pa.float64(),
+        'logmar': pa.float64(),
+        'adaptive_threshold_mean': pa.float64(),
+        'adaptive_threshold_sd': pa.float64(),
+    }
+
+
+def _eye(block_type):
+    """Eye of a block from its block_type, e.g. 'left_response' -> 'left'."""
+    if not isinstance(block_type, str) or '_' not in block_type:
+        return 'none'
+    return block_type.split('_', 1)[0]
+
+
+def _column(values, arrow_type=None):
+    """Build one column, storing 'N/A' and other placeholders that do not fit
+    the column's type as null. A column of unknown type that is null
+    throughout is stored as text rather than with Arrow's null type."""
+    if arrow_type is not None:
+        if pa.types.is_boolean(arrow_type):
+            values = [value if isinstance(value, bool) else None for value in values]
+        elif pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type):
+            values = [value if isinstance(value, (int, float)) else None for value in values]
+        elif pa.types.is_string(arrow_type):
+            values = [None if value is None else str(value) for value in values]
+        return pa.array(values, type=arrow_type)
+    try:
+        column = pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Mixed types, e.g. 'N/A' alongside numbers: keep them as text
+        column = None
+    if column is None or pa.types.is_null(column.type):
+        return pa.array([None if value is None else str(value) for value in values], type=pa.string())
+    return column
+
+
+def trial_table(records, participant):
+    """
+    Build an Arrow table from trial records.
+
+    Args:
+        records (list): Trial dicts, as read from the trial log
+        participant (str): Participant ID, used for the partition column
+
+    Returns:
+        pyarrow.Table: One row per trial, with participant and eye columns
+    """
+    column_types = _column_types()
+    names = list(dict.fromkeys(key for record in records for key in record))
+    columns = {name: _column([record.get(name) for record in records], column_types.get(name))
+               for name in names if name not in PARTITION_COLUMNS}
+    columns['participant'] = pa.array([str(participant)] * len(records), type=pa.string())
+    columns['eye'] = pa.array([_eye(record.get('block_type')) for record in records], type=pa.string())
+    return pa.table(columns)
+
+
+def export_session(log_path, dataset_root, participant, session_name):
+    """
+    Append a session's trials to the study's Parquet dataset.
+
+    Args:
+        log_path (str): Trial log of the session
+        dataset_root (str): Root folder of the dataset
+        participant (str): Participant ID
+        session_name (str): Unique name for this session's files
+
+    Returns:
+        int: Number of trials exported, or None if pyarrow is not installed
+    """
+    if not PARQUET_AVAILABLE:
+        return None
+    records = read_trial_log(log_path)
+    if not records:
+        return 0
+    pq.write_to_dataset(trial_table(records, participant), root_path=dataset_root,
+                        partition_cols=PARTITION_COLUMNS,
+                        basename_template=session_name + '-{i}.parquet',
+                        existing_data_behavior='overwrite_or_ignore')
+    return len(records)
@@ -0,0 +1,83 @@
+"""
+LogMAR to degrees to pixels conversion for the stimulus sizes.
+
+The degrees a LogMAR value maps to depend only on the font, but the pixel
+height they end up as depends on the station's monitor and viewing distance.
+size_table() converts every LogMAR level in one go and is memoised per
+(monitor, distance, font), so the conversion runs once per station setup. The
+table flags sizes that are below one pixel, and sizes that round to the same
+pixel height as another level and so render identically.
+"""
+
+import functools
+from collections import namedtuple
+
+import numpy as np
+
+# Arcmin covered by a letter of height 1 in the Snellen font
+FONT_ARCMIN = 30.0
+
+# All fields are arrays with one entry per LogMAR level, largest size first
+# pixels: letter height on screen; pixel_height: the same rounded to whole pixels
+# below_one_pixel / duplicate_height: flags for levels that cannot be shown as intended
+SizeTable = namedtuple('SizeTable', ['logmar', 'degrees', 'pixels', 'pixel_height',
+                                     'below_one_pixel', 'duplicate_height'])
+
+
+def logmar_to_degrees(logmar, font_arcmin=FONT_ARCMIN):
+    """
+    Convert LogMAR to degrees of visual angle (works on arrays).
+
+    LogMAR = log10(MAR), where MAR = size in arcmin / 5, so the letter is
+    5 * 10^LogMAR arcmin. The font's letter height spans font_arcmin arcmin.
+    """
+    return 5 * 10 ** np.asarray(logmar, dtype=float) / font_arcmin
+
+
+@functools.lru_cache(maxsize=None)
+def size_table(logmars, distance_cm, width_cm, width_px, font, font_arcmin=FONT_ARCMIN):
+    """
+    Build the size table for a set of LogMAR levels on one display.
+
+    Args:
+        logmars (tuple): LogMAR levels
+        distance_cm (float): Viewing distance
+        width_cm (float): Width of the screen
+        width_px (int): Horizontal resolution of the screen
+        font (str): Font name; part of the cache key with font_arcmin
+        font_arcmin (float): Arcmin covered by a letter of height 1 in the font
+
+    Returns:
+        SizeTable: The conversion of every level, largest first
+    """
+    logmar = np.sort(np.asarray(logmars, dtype=float))[::-1]
+    degrees = logmar_to_degrees(logmar, font_arcmin)
+    # Same small-angle conversion as psychopy.tools.monitorunittools.deg2pix
+    pixels = np.deg2rad(degrees) * distance_cm * width_px / width_cm
+    pixel_height = np.round(pixels).astype(int)
+    _, inverse, counts = np.unique(pixel_height, return_inverse=True, return_counts=True)
+    return SizeTable(logmar=logmar,
+                     degrees=degrees,
+                     pixels=pixels,
+                     pixel_height=pixel_height,
+                     below_one_pixel=pixels < 1,
+                     duplicate_height=counts[inverse] > 1)
+
+
+def monitor_size_table(logmars, monitor, font, font_arcmin=FONT_ARCMIN):
+    """size_table() for a psychopy.monitors.Monitor."""
+    return size_table(tuple(float(l) for l in logmars), float(monitor.getDistance()),
+                      float(monitor.getWidth()), int(monitor.getSizePix()[0]), font, font_arcmin)
+
+
+def size_warnings(table):
+    """Describe every level that is below one pixel or shares its pixel height."""
+    warnings = []
+    for logmar, pixels, height, tiny, duplicate in zip(table.logmar, table.pixels, table.pixel_height,
+                                                       table.below_one_pixel, table.duplicate_height):
+        if tiny:
+            warnings.append(f"LogMAR {logmar:.2f} is {pixels:.2f} px high, below one pixel")
+        elif duplicate:
+            same = [f"{other:.2f}" for other in table.logmar[table.pixel_height == height] if other != logmar]
+            warnings.append(f"LogMAR {logmar:.2f} renders at {height} px, the same as LogMAR {', '.join(same)}")
+    return warnings
@@ -0,0 +1,104 @@
+"""
+Append-only, crash-safe log of trial data.
+
+Each completed trial is appended to a JSON Lines file as one line, so saving a
+trial costs the same however long the session has been running. Lines are
+written to the file straight away but only fsynced in batches, when sync() is
+called between trials (e.g. while the "next trial" message is on screen). A
+crash loses at most the trials since the last sync, and a partly written last
+line is skipped when the log is read back.
+
+The end-of-session CSV is derived from the log by write_csv().
+"""
+
+import csv
+import json
+import math
+import os
+
+
+def _to_json(value):
+    """Convert NumPy scalars and arrays for json.dumps."""
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+class TrialLogWriter:
+    """
+    Appends one JSON object per trial to a log file.
+
+    Args:
+        path (str): JSON Lines file to append to
+        fsync_every (int): Number of trials to batch before sync() fsyncs
+    """
+
+    def __init__(self, path, fsync_every=5):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.pending = 0
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def append(self, record):
+        """Write a trial to the log. It is durable after the next sync()."""
+        self.file.write(json.dumps(record, default=_to_json) + '\n')
+        self.pending += 1
+
+    def sync(self, force=False):
+        """
+        Hand buffered trials to the OS, and fsync them to disk once
+        fsync_every trials are pending (or when force is set).
+        """
+        self.file.flush()
+        if self.pending and (force or self.pending >= self.fsync_every):
+            os.fsync(self.file.fileno())
+            self.pending = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.sync(force=True)
+            self.file.close()
+
+
+def read_trial_log(path):
+    """
+    Read every complete trial from a log.
+
+    Returns:
+        list: One dict per trial, in the order they were written
+    """
+    records = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                break  # Partly written last line from a crash
+    return records
+
+
+def _csv_value(value):
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ''
+    return value
+
+
+def write_csv(log_path, csv_path):
+    """
+    Write the trials in a log as a wide CSV, one row per trial. Columns are in
+    the order they first appear; list values (e.g. the stream) are written as
+    JSON.
+
+    Returns:
+        int: Number of trials written
+    """
+    records = read_trial_log(log_path)
+    fieldnames = list(dict.fromkeys(key for record in records for key in record))
+    with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        for record in records:
+            writer.writerow({key: _csv_value(value) for key, value in record.items()})
+    return len(records)
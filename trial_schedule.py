@@ -0,0 +1,124 @@
+"""
+Frame schedules for RSVP trials.
+
+A trial is compiled into flat per-frame arrays (which stimulus to draw, the
+photodiode state and the trigger code to send) before the stream starts, so
+the presentation loop only has to index arrays, draw and flip.
+"""
+
+import numpy as np
+
+
+class CompiledTrial:
+    """
+    Per-frame schedule for one RSVP stream.
+
+    Attributes:
+        stims (list): Unique stimuli drawn during the stream
+        stim_ids (np.ndarray): Index into stims for each frame
+        photodiode (np.ndarray): 1 on frames where the photodiode patch is
+            white, 0 where it is black
+        triggers (np.ndarray): Trigger code to send on each frame, 0 for none
+        messages (dict): Log messages or event records keyed by frame index
+        item_onsets (np.ndarray): Frame index of each stream item's onset
+    """
+
+    def __init__(self, stims, stim_ids, photodiode, triggers, messages, item_onsets):
+        self.stims = stims
+        self.stim_ids = stim_ids
+        self.photodiode = photodiode
+        self.triggers = triggers
+        self.messages = messages
+        self.item_onsets = item_onsets
+
+    @property
+    def n_frames(self):
+        return len(self.stim_ids)
+
+
+def compile_trial(item_stims, item_duration_frames, item_triggers=None, item_messages=None,
+                  lead_in_stim=None, lead_in_frames=0, lead_in_trigger=0, lead_in_message=None):
+    """
+    Compile an RSVP stream into a CompiledTrial.
+
+    Args:
+        item_stims (list): Stimulus to draw for each stream item
+        item_duration_frames (int): Number of frames each item is shown for
+        item_triggers (dict): Trigger code to send at the onset of an item,
+            keyed by the item's index in the stream
+        item_messages (dict): Log message or event record for the onset of an
+            item, keyed by the item's index in the stream
+        lead_in_stim: Stimulus shown before the first item (e.g. fixation)
+        lead_in_frames (int): Number of lead-in frames
+        lead_in_trigger (int): Trigger code sent on the first lead-in frame
+        lead_in_message: Log message or event record for the first lead-in frame
+
+    Returns:
+        CompiledTrial: The frame schedule
+    """
+    item_triggers = item_triggers or {}
+    item_messages = item_messages or {}
+
+    stims = []
+    stim_index = {}
+
+    def index_of(stim):
+        # Stimuli are de-duplicated by identity, so repeated items share an id
+        key = id(stim)
+        if key not in stim_index:
+            stim_index[key] = len(stims)
+            stims.append(stim)
+        return stim_index[key]
+
+    n_frames = lead_in_frames + len(item_stims) * item_duration_frames
+    stim_ids = np.empty(n_frames, dtype=np.int16)
+    photodiode = np.zeros(n_frames, dtype=np.uint8)
+    triggers = np.zeros(n_frames, dtype=np.uint8)
+    messages = {}
+
+    if lead_in_frames:
+        stim_ids[:lead_in_frames] = index_of(lead_in_stim)
+        triggers[0] = lead_in_trigger
+        if lead_in_message:
+            messages[0] = lead_in_message
+
+    item_onsets = lead_in_frames + np.arange(len(item_stims)) * item_duration_frames
+    for i, stim in enumerate(item_stims):
+        onset = int(item_onsets[i])
+        stim_ids[onset:onset + item_duration_frames] = index_of(stim)
+        # The photodiode patch is white on the first frame of every item
+        photodiode[onset] = 1
+        if i in item_triggers:
+            triggers[onset] = item_triggers[i]
+        if i in item_messages:
+            messages[onset] = item_messages[i]
+
+    return CompiledTrial(stims, stim_ids, photodiode, triggers, messages, item_onsets)
+
+
+def frame_timing(flip_times, frame_dur, target_onset_frame, target_offset_frame, drop_tolerance=1.5):
+    """
+    Summarise the flip timestamps recorded while a compiled trial was shown.
+
+    Args:
+        flip_times (np.ndarray): Timestamp returned by win.flip() for each
+            frame, plus the flip that ended the stream
+        frame_dur (float): Expected frame duration in seconds
+        target_onset_frame (int): Frame index of the target's onset
+        target_offset_frame (int): Frame index of the first frame after the target
+        drop_tolerance (float): An interval longer than this many frame
+            durations counts as having dropped frames
+
+    Returns:
+        dict: Max flip interval (ms), number of dropped frames and the actual
+              target duration (ms)
+    """
+    intervals = np.diff(flip_times)
+    late = intervals > frame_dur * drop_tolerance
+    # A late interval spanning n refreshes means n - 1 frames were dropped
+    dropped = int(np.sum(np.maximum(np.round(intervals[late] / frame_dur) - 1, 1)))
+    return {
+        'frame_max_interval_ms': float(intervals.max()) * 1000 if len(intervals) else float('nan'),
+        'frame_dropped_count': dropped,
+        'target_duration_ms': float(flip_times[target_offset_frame] - flip_times[target_onset_frame]) * 1000,
+    }
@@ -0,0 +1,226 @@
+"""
+Trigger latency benchmark.
+
+Runs the trigger paths used by the experiment scripts against local
+stand-ins, so trigger code can be measured without a lab rig:
+
+- LabJack: the real labjackU3.trigger path and u3.U3.getFeedback, with
+  Device._writeRead replaced by a simulated U3 that models USB latency and
+  executes PortStateWrite / WaitShort / WaitLong on a simulated FIO port.
+- Serial: the serial_trigger writer thread used by rsvp_experiment_letters.py,
+  and the direct port.write(code), port.write(0) path it replaced, against
+  one end of a pty pair, with a reader thread timestamping bytes as they
+  come out of the other end.
+
+For each path it reports p50/p99 latency of the send call, p50/p99 latency
+until the code reaches the (simulated) port, the number of threads alive
+while triggering and the error of the pulse width seen on the port.
+
+Usage:
+    python trigger_benchmark.py --triggers 2000 --interval-ms 10
+"""
+
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+import serial
+
+import u3
+import labjackU3
+import serial_trigger
+from LabJackPython import setChecksum
+
+SERIAL_BAUD_RATE = 115200
+
+
+class SimulatedU3(u3.U3):
+    """
+    U3 whose USB transport is simulated.
+
+    Every _writeRead sleeps for a modelled USB latency, executes the feedback
+    commands in the packet against a simulated FIO port and answers with a
+    valid, checksummed feedback response.
+
+    Args:
+        usb_latency (float): Mean round-trip time of one packet in seconds
+        usb_jitter (float): Standard deviation of the round-trip time
+        seed (int): Seed for the latency model
+    """
+
+    def __init__(self, usb_latency=0.0006, usb_jitter=0.0001, seed=0):
+        u3.U3.__init__(self, autoOpen=False)
+        self.usb_latency = usb_latency
+        self.usb_jitter = usb_jitter
+        self.rng = np.random.default_rng(seed)
+        self.port_events = []  # (time, FIO value) each time the port changes
+
+    def _writeRead(self, command, readLen, commandBytes, checkBytes=True, stream=False, checksum=True):
+        latency = max(0.0, self.rng.normal(self.usb_latency, self.usb_jitter))
+        # Half the round trip to reach the card, the rest on the way back
+        time.sleep(latency / 2)
+        self._execute(command)
+        time.sleep(latency / 2)
+
+        response = [0] * readLen
+        response[1] = 0xF8
+        response[2] = (readLen - 6) // 2
+        return setChecksum(response)
+
+    def _execute(self, command):
+        """Run the feedback commands in a packet on the simulated port."""
+        i = 7
+        while i < len(command):
+            command_id = command[i]
+            if command_id == 27:    # PortStateWrite: id, 3 mask bytes, 3 state bytes
+                self.port_events.append((time.perf_counter(), command[i + 4]))
+                i += 7
+            elif command_id == 5:   # WaitShort
+                time.sleep(command[i + 1] * labjackU3.WAIT_SHORT_US / 1e6)
+                i += 2
+            elif command_id == 6:   # WaitLong
+                time.sleep(command[i + 1] * labjackU3.WAIT_LONG_US / 1e6)
+                i += 2
+            else:                   # Padding byte
+                i += 1
+
+
+def pulse_widths(events, duration):
+    """
+    Return the arrival time of each code on the port, its pulse width error
+    (s) and the code. A pulse ends at the next 0, or early if another code
+    replaces it before it was cleared.
+    """
+    onsets, errors, codes = [], [], []
+    pending = None
+    for t, value in events:
+        if pending is not None and value != pending[1]:
+            onsets.append(pending[0])
+            errors.append((t - pending[0]) - duration)
+            codes.append(pending[1])
+            pending = None
+        if value != 0 and pending is None:
+            pending = (t, value)
+    return np.array(onsets), np.array(errors), codes
+
+
+def summarise(name, call_times, arrival_latencies, width_errors, max_threads):
+    def ms(values, q):
+        return np.percentile(values, q) * 1000 if len(values) else float('nan')
+
+    print(f"\n{name}")
+    print(f"  send call      p50 {ms(call_times, 50):8.4f} ms   p99 {ms(call_times, 99):8.4f} ms")
+    print(f"  to port        p50 {ms(arrival_latencies, 50):8.4f} ms   p99 {ms(arrival_latencies, 99):8.4f} ms")
+    print(f"  width error    p50 {ms(np.abs(width_errors), 50):8.4f} ms   p99 {ms(np.abs(width_errors), 99):8.4f} ms")
+    print(f"  threads alive  max {max_threads}")
+
+
+def run_trigger_loop(send, n_triggers, interval):
+    """Send n_triggers codes interval seconds apart and time each call."""
+    codes = [(i % 19) + 1 for i in range(n_triggers)]
+    call_times = np.empty(n_triggers)
+    requested = np.empty(n_triggers)
+    max_threads = threading.active_count()
+
+    next_onset = time.perf_counter()
+    for i, code in enumerate(codes):
+        labjackU3.wait_until(next_onset)
+        start = time.perf_counter()
+        send(code)
+        end = time.perf_counter()
+        call_times[i] = end - start
+        requested[i] = start
+        max_threads = max(max_threads, threading.active_count())
+        next_onset += interval
+    return codes, call_times, requested, max_threads
+
+
+def benchmark_labjack(n_triggers, interval, duration, pulse_mode, usb_latency, usb_jitter):
+    card = SimulatedU3(usb_latency=usb_latency, usb_jitter=usb_jitter)
+    labjackU3.u3card = card
+    labjackU3.clock = time.perf_counter
+    labjackU3.DURATION = duration
+    labjackU3.PULSE_MODE = pulse_mode
+    labjackU3.start_dispatcher()
+
+    codes, call_times, requested, max_threads = run_trigger_loop(labjackU3.trigger, n_triggers, interval)
+    labjackU3.close()
+
+    onsets, width_errors, seen = pulse_widths(card.port_events, duration)
+    if seen != codes:
+        print(f"WARNING: {len(codes)} triggers sent but {len(seen)} pulses seen on the simulated port")
+    n = min(len(onsets), len(requested))
+    summarise(f"LabJack U3 ({'pulse' if pulse_mode else 'scheduled clear'} mode, {n_triggers} triggers)",
+              call_times, onsets[:n] - requested[:n], width_errors, max_threads)
+
+
+def benchmark_serial(n_triggers, interval, pulse_width, use_writer):
+    master, slave = os.openpty()
+    events = []
+    stop = threading.Event()
+
+    def reader():
+        while not stop.is_set():
+            data = os.read(master, 64)
+            now = time.perf_counter()
+            events.extend((now, b) for b in data)
+
+    reader_thread = threading.Thread(target=reader, daemon=True)
+    reader_thread.start()
+
+    if use_writer:
+        serial_trigger.clock = time.perf_counter
+        serial_trigger.PULSE_WIDTH = pulse_width
+        port = serial_trigger.configure(os.ttyname(slave), SERIAL_BAUD_RATE)
+        send = serial_trigger.trigger
+    else:
+        port = serial.Serial(os.ttyname(slave), baudrate=SERIAL_BAUD_RATE)
+        pulse_width = 0.0  # The direct path has no pulse width, so the error is the width itself
+
+        def send(code):
+            port.write(bytes([code]))
+            port.write(bytes([0]))
+
+    codes, call_times, requested, max_threads = run_trigger_loop(send, n_triggers, interval)
+    if use_writer:
+        serial_trigger.trigger_log.clear()
+        serial_trigger.close()
+    time.sleep(0.1)
+    stop.set()
+    os.write(slave, bytes([0]))  # Unblock the reader
+    reader_thread.join(timeout=1.0)
+    if not use_writer:
+        port.close()
+    os.close(master)
+    os.close(slave)
+
+    onsets, width_errors, seen = pulse_widths(events, pulse_width)
+    n = min(len(onsets), len(requested))
+    summarise(f"Serial ({'writer thread' if use_writer else 'direct writes'}, {n_triggers} triggers, pty)",
+              call_times, onsets[:n] - requested[:n], width_errors, max_threads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--triggers', type=int, default=2000, help="Number of triggers per path")
+    parser.add_argument('--interval-ms', type=float, default=10.0, help="Time between triggers")
+    parser.add_argument('--duration-ms', type=float, default=5.0, help="LabJack and serial writer pulse width")
+    parser.add_argument('--usb-latency-ms', type=float, default=0.6, help="Mean simulated USB round trip")
+    parser.add_argument('--usb-jitter-ms', type=float, default=0.1, help="SD of the simulated USB round trip")
+    parser.add_argument('--skip-serial', action='store_true', help="Only benchmark the LabJack path")
+    args = parser.parse_args()
+
+    interval = args.interval_ms / 1000
+    duration = args.duration_ms / 1000
+    for pulse_mode in (True, False):
+        benchmark_labjack(args.triggers, interval, duration, pulse_mode,
+                          args.usb_latency_ms / 1000, args.usb_jitter_ms / 1000)
+    if not args.skip_serial:
+        for use_writer in (True, False):
+            benchmark_serial(args.triggers, interval, duration, use_writer)
+
+
+if __name__ == '__main__':
+    main()
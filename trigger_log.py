@@ -0,0 +1,58 @@
+"""
+Fixed-size ring buffer of trigger timestamps.
+
+Trigger backends record when each trigger was requested, the flip it is tied
+to, and when the write to the device started and completed. Every slot is
+preallocated, so recording a trigger does no allocation or string formatting;
+the entries are read back and logged after the trial.
+"""
+
+import numpy as np
+
+TRIGGER_LOG_DTYPE = np.dtype([
+    ('code', 'u1'),         # Trigger value
+    ('requested', 'f8'),    # When the trigger was handed to the backend
+    ('flip', 'f8'),         # Flip the trigger belongs to (NaN if not flip-locked)
+    ('sent', 'f8'),         # When the write to the device started
+    ('completed', 'f8'),    # When the write to the device returned
+])
+
+
+class TriggerLog:
+    """
+    Ring buffer of TRIGGER_LOG_DTYPE records.
+
+    Args:
+        capacity (int): Number of triggers kept before the oldest is overwritten
+    """
+
+    def __init__(self, capacity=256):
+        self.records = np.zeros(capacity, dtype=TRIGGER_LOG_DTYPE)
+        self.count = 0
+
+    def add(self, code, requested, flip=np.nan):
+        """Start a record for a trigger and return its slot."""
+        slot = self.count % len(self.records)
+        record = self.records[slot]
+        record['code'] = code
+        record['requested'] = requested
+        record['flip'] = flip
+        record['sent'] = np.nan
+        record['completed'] = np.nan
+        self.count += 1
+        return slot
+
+    def mark(self, slot, field, timestamp):
+        """Set one of the timestamps of a record."""
+        self.records[slot][field] = timestamp
+
+    def entries(self):
+        """Copy of the records since the last clear(), oldest first."""
+        capacity = len(self.records)
+        if self.count <= capacity:
+            return self.records[:self.count].copy()
+        start = self.count % capacity
+        return np.concatenate((self.records[start:], self.records[:start]))
+
+    def clear(self):
+        self.count = 0
@@ -17,6 +17,8 @@ Section Number Mapping:
 
 """
 import collections
+import ctypes
+import os
 import sys
 import warnings
 
@@ -27,6 +29,8 @@ except ImportError: # Python 3
 
 from struct import pack, unpack
 
+import numpy as np
+
 from LabJackPython import (
     Device,
     deviceCount,
@@ -34,7 +38,9 @@ from LabJackPython import (
     LowlevelErrorException,
     lowlevelErrorToString,
     MAX_USB_PACKET_LENGTH,
+    setChecksum,
     setChecksum8,
+    staticLib,
     toDouble,
     )
 
@@ -96,6 +102,7 @@ class U3(Device):
         Device.__init__(self, None, devType = 3)
         self.debug = debug
         self.calData = None
+        self.ainCalibration = dict()
         self.ledState = True
 
         if autoOpen:
@@ -302,6 +309,8 @@ class U3(Device):
         elif self.versionInfo == 18:
             self.deviceName += '-HV'
             self.isHV = True
+        # Coefficients depend on isHV
+        self.ainCalibration = dict()
 
         return {'FirmwareVersion': self.firmwareVersion, 'BootloaderVersion': self.bootloaderVersion, 'HardwareVersion': self.hardwareVersion, 'SerialNumber': self.serialNumber, 'ProductID': self.productId, 'LocalID': self.localId, 'TimerCounterMask': self.timerCounterMask, 'FIOAnalog': self.fioAnalog, 'FIODirection': self.fioDirection, 'FIOState': self.fioState, 'EIOAnalog': self.eioAnalog, 'EIODirection': self.eioDirection, 'EIOState': self.eioState, 'CIODirection': self.cioDirection, 'CIOState': self.cioState, 'DAC1Enable': self.dac1Enable, 'DAC0': self.dac0, 'DAC1': self.dac1, 'TimerClockConfig': self.timerClockConfig, 'TimerClockDivisor': self.timerClockDivisor, 'CompatibilityOptions': self.compatibilityOptions, 'VersionInfo': self.versionInfo, 'DeviceName': self.deviceName}
     configU3.section = 2
@@ -600,30 +609,18 @@ class U3(Device):
         >>> print(d.getAIN(0))
         0.0501680038869
         """
-        isSpecial = False
-
-        if negChannel == 32:
-            isSpecial = True
-            negChannel = 30
-
-        bits = self.getFeedback(AIN(posChannel, negChannel, longSettle, quickSample))[0]
-
-        singleEnded = True
-        if negChannel != 31:
-            singleEnded = False
-
-        lvChannel = True
-
         try:
-            if self.isHV and posChannel < 4:
-                lvChannel = False
-        except AttributeError:
-            pass
+            slope, offset = self.ainCalibration[(posChannel, negChannel)]
+        except KeyError:
+            slope, offset = self._analogCalibration(posChannel, negChannel)
+            self.ainCalibration[(posChannel, negChannel)] = (slope, offset)
 
-        if isSpecial:
-            negChannel = 32
+        if negChannel == 32:
+            bits = self.getFeedback(AIN(posChannel, 30, longSettle, quickSample))[0]
+        else:
+            bits = self.getFeedback(AIN(posChannel, negChannel, longSettle, quickSample))[0]
 
-        return self.binaryToCalibratedAnalogVoltage(bits, isLowVoltage = lvChannel, isSingleEnded = singleEnded, isSpecialSetting = isSpecial, channelNumber = posChannel)
+        return bits * slope + offset
     getAIN.section = 3
 
     def configAnalog(self, *args):
@@ -735,32 +732,11 @@ class U3(Device):
         return results
     _buildFeedbackResults.section = 4
 
-    def getFeedback(self, *commandlist):
+    def _buildFeedbackPacket(self, commandlist):
         """
-        Name: U3.getFeedback(commandlist)
-        
-        Args: the FeedbackCommands to run
-        
-        Desc: Forms the commandlist into a packet, sends it to the U3, and reads the response.
-        
-        Examples:
-        >>> myU3 = u3.U3()
-        >>> ledCommand = u3.LED(False)
-        >>> ain0Command = u3.AIN(0, 31, True)
-        >>> myU3.getFeedback(ledCommand, ain0Command)
-        [None, 9376]
-
-        OR if you like the list version better:
-        
-        >>> myU3 = U3()
-        >>> ledCommand = u3.LED(False)
-        >>> ain0Command = u3.AIN(30, 31, True)
-        >>> commandList = [ ledCommand, ain0Command ]
-        >>> myU3.getFeedback(commandList)
-        [None, 9376]
-        
+        Builds the packet for getFeedback, without checksums. Returns the
+        packet and the length of its response.
         """
-        
         sendBuffer = [0] * 7
         sendBuffer[1] = 0xF8
         readLen = 9
@@ -778,10 +754,14 @@ class U3(Device):
         
         if readLen > MAX_USB_PACKET_LENGTH:
             raise LabJackException("ERROR: The feedback command you are attempting to send would yield a response that is greater than 64 bytes ( %s bytes ). Break your commands up into separate calls to getFeedback()." % readLen)
-        
-        rcvBuffer = self._writeRead(sendBuffer, readLen, [], checkBytes = False, stream = False, checksum = True)
-        
-        # Check the response for errors
+
+        return sendBuffer, readLen
+    _buildFeedbackPacket.section = 4
+
+    def _checkFeedbackResponse(self, rcvBuffer, commandlist):
+        """
+        Checks a getFeedback response for errors
+        """
         try:
             self._checkCommandBytes(rcvBuffer, [0xF8])
         
@@ -794,12 +774,81 @@ class U3(Device):
                 culprit = commandlist[ (rcvBuffer[7] -1) ]
             
             raise LowlevelErrorException("\nThis Command\n    %s\nreturned an error:\n    %s" %  (culprit , lowlevelErrorToString(rcvBuffer[6])))
-            
+    _checkFeedbackResponse.section = 4
+
+    def getFeedback(self, *commandlist):
+        """
+        Name: U3.getFeedback(commandlist)
+        
+        Args: the FeedbackCommands to run
+        
+        Desc: Forms the commandlist into a packet, sends it to the U3, and reads the response.
+        
+        Examples:
+        >>> myU3 = u3.U3()
+        >>> ledCommand = u3.LED(False)
+        >>> ain0Command = u3.AIN(0, 31, True)
+        >>> myU3.getFeedback(ledCommand, ain0Command)
+        [None, 9376]
+
+        OR if you like the list version better:
         
+        >>> myU3 = U3()
+        >>> ledCommand = u3.LED(False)
+        >>> ain0Command = u3.AIN(30, 31, True)
+        >>> commandList = [ ledCommand, ain0Command ]
+        >>> myU3.getFeedback(commandList)
+        [None, 9376]
+        
+        """
+        
+        sendBuffer, readLen = self._buildFeedbackPacket(commandlist)
+
+        rcvBuffer = self._writeRead(sendBuffer, readLen, [], checkBytes = False, stream = False, checksum = True)
+
+        self._checkFeedbackResponse(rcvBuffer, commandlist)
+
         results = []
         i = 9
         return self._buildFeedbackResults(rcvBuffer, commandlist, results, i)
     getFeedback.section = 2    
+
+    def prepareFeedback(self, *commandlist):
+        """
+        Name: U3.prepareFeedback(commandlist)
+
+        Args: the FeedbackCommands to run
+
+        Desc: Builds the packet getFeedback would send for commandlist once,
+              for commands that are sent over and over. Returns a
+              PreparedFeedback; see its send() and setByte().
+
+        Example:
+        >>> myU3 = u3.U3()
+        >>> fio = myU3.prepareFeedback(u3.PortStateWrite(State = [0, 0, 0], WriteMask = [0xff, 0, 0]))
+        >>> fio.setByte(fio.commandOffsets[0] + 4, 0x05)
+        >>> fio.send()
+        [None]
+        """
+        return PreparedFeedback(self, commandlist)
+    prepareFeedback.section = 3
+
+    def _writeReadPrepared(self, prepared):
+        """
+        Sends the packet of a PreparedFeedback, which already has its
+        checksums, and returns the response. With the Exodriver the packet's
+        bytearray is handed to the driver as it is.
+        """
+        if os.name == 'posix' and staticLib is not None and isinstance(self.handle, ctypes.c_void_p):
+            with self.deviceLock:
+                writeBytes = staticLib.LJUSB_Write(self.handle, ctypes.byref(prepared.writeArray), len(prepared.packet))
+                if writeBytes != len(prepared.packet):
+                    raise LabJackException( "Could only write %s of %s bytes." % (writeBytes, len(prepared.packet) ) )
+                readBytes = staticLib.LJUSB_Read(self.handle, ctypes.byref(prepared.readArray), prepared.readLen)
+                return prepared.readArray[:readBytes]
+
+        return self._writeRead(prepared.packet, prepared.readLen, [], checkBytes = False, stream = False, checksum = False)
+    _writeReadPrepared.section = 4
     
     def readMem(self, blockNum, readCal=False):
         """
@@ -1084,6 +1133,7 @@ class U3(Device):
         self.streamSamplesPerPacket = SamplesPerPacket
         self.streamChannelNumbers = PChannels
         self.streamNegChannels = NChannels
+        self.streamCalibration = self._streamCalibration()
 
         self.streamConfiged = True
         if InternalStreamClockFrequency == 1:
@@ -1113,53 +1163,79 @@ class U3(Device):
         Desc: Breaks stream data into individual channels and applies
               calibrations.
 
+              The whole block is decoded at once with NumPy: the samples of
+              every packet are viewed as one array of little-endian 16-bit
+              words, each channel is taken out of the scan by stride, and
+              analog channels are calibrated with one multiply-add using
+              the coefficients streamConfig() looked up for them. Each entry
+              is a contiguous NumPy array: float64 volts for analog inputs,
+              uint16 for timers and counters (200+), and uint8 pairs
+              (LSB, MSB) for the digital states (193, 194).
+
         >>> reading = d.streamData(convert = False)
         >>> print(processStreamData(reading['result']))
-        defaultDict(list, {'AIN0' : [3.123, 3.231, 3.232, ...]})
+        {'AIN0' : array([3.123, 3.231, 3.232, ...])}
         """
         if numBytes is None:
             numBytes = 14 + (self.streamSamplesPerPacket * 2)
 
-        returnDict = collections.defaultdict(list)
-
         numChannels = len(self.streamChannelNumbers)
 
-        for packet in self.breakupPackets(result, numBytes):
-            for sample in self.samplesFromPacket(packet):
-                if self.streamPacketOffset >= numChannels:
-                    self.streamPacketOffset = 0
-
-                if self.streamChannelNumbers[self.streamPacketOffset] in (193, 194):
-                    value = unpack('<BB', sample)
-                elif self.streamChannelNumbers[self.streamPacketOffset] >= 200:
-                    value = unpack('<H', sample)[0]
-                else:
-                    if self.streamNegChannels[self.streamPacketOffset] == 31:
-                        # do unsigned
-                        value = unpack('<H', sample)[0]
-                        singleEnded = True
-                    else:
-                        # do signed
-                        value = unpack('<H', sample)[0]
-                        singleEnded = False
-
-                    lvChannel = True
-                    if self.isHV and self.streamChannelNumbers[self.streamPacketOffset] < 4:
-                        lvChannel = False
-
-                    isSpecial = False
-                    if self.streamNegChannels[self.streamPacketOffset] == 32:
-                        isSpecial = True
-
-                    value = self.binaryToCalibratedAnalogVoltage(value, isLowVoltage = lvChannel, isSingleEnded = singleEnded, channelNumber = self.streamChannelNumbers[self.streamPacketOffset], isSpecialSetting = isSpecial)
-
-                returnDict["AIN%s" % self.streamChannelNumbers[self.streamPacketOffset]].append(value)
+        buf = np.frombuffer(result, dtype = np.uint8)
+        numPackets = len(buf) // numBytes
+        # Drop the 12 byte header and 2 byte footer of each packet
+        packets = buf[:numPackets * numBytes].reshape(numPackets, numBytes)[:, 12:numBytes - 2]
+        samples = np.ascontiguousarray(packets).view('<u2').ravel()
+
+        # The scan continues across blocks, so the first sample belongs to
+        # the channel after the last one of the previous block
+        offset = self.streamPacketOffset % numChannels
+        positions = collections.OrderedDict()
+        for i, channel in enumerate(self.streamChannelNumbers):
+            positions.setdefault("AIN%s" % channel, []).append(i)
+
+        slopes, offsets = self.streamCalibration
+
+        returnDict = dict()
+        for name, indexes in positions.items():
+            if len(indexes) == 1:
+                scanIndex = indexes[0]
+                raw = samples[(scanIndex - offset) % numChannels::numChannels]
+            else:
+                # A channel listed more than once: keep its samples in scan order
+                scanIndex = (offset + np.arange(len(samples))) % numChannels
+                inChannel = np.isin(scanIndex, indexes)
+                scanIndex, raw = scanIndex[inChannel], samples[inChannel]
+
+            channel = self.streamChannelNumbers[indexes[0]]
+            if channel in (193, 194):
+                returnDict[name] = np.stack((raw & 0xFF, raw >> 8), axis = 1).astype(np.uint8)
+            elif channel >= 200:
+                returnDict[name] = np.ascontiguousarray(raw, dtype = np.uint16)
+            else:
+                returnDict[name] = raw * slopes[scanIndex] + offsets[scanIndex]
 
-                self.streamPacketOffset += 1
+        self.streamPacketOffset = (offset + len(samples)) % numChannels
 
         return returnDict
     processStreamData.section = 3
 
+    def _streamCalibration(self):
+        """
+        Returns arrays of the slope and offset that convert the bits of each
+        analog channel in the stream's channel list to volts (NaN for digital,
+        timer and counter channels).
+        """
+        numChannels = len(self.streamChannelNumbers)
+        slopes = np.full(numChannels, np.nan)
+        offsets = np.full(numChannels, np.nan)
+        for i, (channel, negChannel) in enumerate(zip(self.streamChannelNumbers, self.streamNegChannels)):
+            if channel in (193, 194) or channel >= 200:
+                continue
+            slopes[i], offsets[i] = self._analogCalibration(channel, negChannel)
+        return slopes, offsets
+    _streamCalibration.section = 4
+
     def watchdog(self, ResetOnTimeout = False, SetDIOStateOnTimeout = False, TimeoutPeriod = 60, DIOState = 0, DIONumber = 0, onlyRead = False):
         """
         Name: U3.watchdog(ResetOnTimeout = False, SetDIOStateOnTimeout = False,
@@ -1633,43 +1709,62 @@ class U3(Device):
         >>> print(d.binaryToCalibratedAnalogVoltage(bits))
         0.046464288000000006
         """
+        slope, offset = self._calibrationCoefficients(isLowVoltage, isSingleEnded, isSpecialSetting, channelNumber)
+        return ( bits * slope ) + offset
+    binaryToCalibratedAnalogVoltage.section = 3
+    
+    def _calibrationCoefficients(self, isLowVoltage = True, isSingleEnded = True, isSpecialSetting = False, channelNumber = 0):
+        """
+        Returns the (slope, offset) that binaryToCalibratedAnalogVoltage()
+        applies to the bits of a reading with the given settings.
+        """
         hasCal = self.calData is not None
         if isLowVoltage:
             if isSingleEnded and not isSpecialSetting:
                 if hasCal:
-                    return ( bits * self.calData['lvSESlope'] ) + self.calData['lvSEOffset']
+                    return self.calData['lvSESlope'], self.calData['lvSEOffset']
                 else:
-                    return ( bits * 0.000037231 ) + 0
+                    return 0.000037231, 0
             elif isSpecialSetting:
                 if hasCal:
-                    return ( bits * self.calData['lvDiffSlope'] ) + self.calData['lvDiffOffset'] + self.calData['vRefAtCAl']
+                    return self.calData['lvDiffSlope'], self.calData['lvDiffOffset'] + self.calData['vRefAtCAl']
                 else:
-                    return (bits * 0.000074463)
+                    return 0.000074463, 0
             else:
                 if hasCal:
-                    return ( bits * self.calData['lvDiffSlope'] ) + self.calData['lvDiffOffset']
+                    return self.calData['lvDiffSlope'], self.calData['lvDiffOffset']
                 else:
-                    return (bits * 0.000074463) - 2.44
+                    return 0.000074463, -2.44
         else:
             if isSingleEnded and not isSpecialSetting:
                 if hasCal:
-                    return ( bits * self.calData['hvAIN%sSlope' % channelNumber] ) + self.calData['hvAIN%sOffset' % channelNumber]
+                    return self.calData['hvAIN%sSlope' % channelNumber], self.calData['hvAIN%sOffset' % channelNumber]
                 else:
-                    return ( bits * 0.000314 ) + -10.3
+                    return 0.000314, -10.3
             elif isSpecialSetting:
                 if hasCal:
                     hvSlope = self.calData['hvAIN%sSlope' % channelNumber]
                     hvOffset = self.calData['hvAIN%sOffset' % channelNumber]
-                    
-                    diffR = ( bits * self.calData['lvDiffSlope'] ) + self.calData['lvDiffOffset'] + self.calData['vRefAtCAl']
-                    reading = diffR * hvSlope / self.calData['lvSESlope'] + hvOffset
-                    return reading
+
+                    # The special range reading scaled to the HV range
+                    scale = hvSlope / self.calData['lvSESlope']
+                    return self.calData['lvDiffSlope'] * scale, ( self.calData['lvDiffOffset'] + self.calData['vRefAtCAl'] ) * scale + hvOffset
                 else:
-                    return (bits * 0.000074463) * (0.000314 / 0.000037231) + -10.3
+                    return 0.000074463 * (0.000314 / 0.000037231), -10.3
             else:
                 raise Exception("Can't do differential on high voltage channels")
-    binaryToCalibratedAnalogVoltage.section = 3
-    
+    _calibrationCoefficients.section = 4
+
+    def _analogCalibration(self, posChannel, negChannel):
+        """
+        Returns the (slope, offset) that convert the bits read from posChannel
+        against negChannel (31 for single-ended, 32 for the special range) to
+        volts.
+        """
+        lvChannel = not (getattr(self, 'isHV', False) and posChannel < 4)
+        return self._calibrationCoefficients(isLowVoltage = lvChannel, isSingleEnded = negChannel == 31, isSpecialSetting = negChannel == 32, channelNumber = posChannel)
+    _analogCalibration.section = 4
+
     def binaryToCalibratedAnalogTemperature(self, bytesTemperature):
         hasCal = self.calData is not None
         
@@ -1757,6 +1852,11 @@ class U3(Device):
                 #not an invalid block error, so do not disregard
                 raise ex
 
+        # Rebuild the coefficient tables from the new calibration
+        self.ainCalibration = dict()
+        if self.streamConfiged:
+            self.streamCalibration = self._streamCalibration()
+
         return self.calData
     getCalibrationData.section = 3
     
@@ -2011,6 +2111,70 @@ class U3(Device):
                 self.getFeedback( Timer1Config(mode, value) )
     loadConfig.section = 3      
 
+class PreparedFeedback(object):
+    """
+    A getFeedback packet built once, from U3.prepareFeedback().
+
+    The packet is kept in a bytearray with its checksums set. setByte()
+    changes one byte of a command in place and patches the checksums, and
+    send() writes the packet as it is, so sending it again only costs the
+    USB round trip. Not thread-safe: use each PreparedFeedback from one
+    thread.
+
+    commandOffsets holds the index in packet of the first byte (the command
+    number) of each command. For example, the FIO state byte of a
+    PortStateWrite is at commandOffsets[i] + 4.
+    """
+    def __init__(self, device, commandlist):
+        self.device = device
+        self.commandlist = commandlist
+        sendBuffer, self.readLen = device._buildFeedbackPacket(commandlist)
+        self.packet = bytearray(setChecksum(sendBuffer))
+        # The driver reads and writes these in place
+        self.writeArray = (ctypes.c_ubyte * len(self.packet)).from_buffer(self.packet)
+        self.readArray = (ctypes.c_ubyte * self.readLen)()
+
+        self.commandOffsets = []
+        offset = 7
+        for cmd in self._flatten(commandlist):
+            self.commandOffsets.append(offset)
+            offset += len(cmd.cmdBytes)
+
+    def _flatten(self, commandlist):
+        for cmd in commandlist:
+            if isinstance(cmd, FeedbackCommand):
+                yield cmd
+            elif isinstance(cmd, list):
+                for subcmd in self._flatten(cmd):
+                    yield subcmd
+
+    def setByte(self, index, value):
+        """
+        Sets packet[index] (a command byte, index >= 7) and updates the
+        checksums.
+        """
+        if index < 7 or index >= len(self.packet):
+            raise LabJackException("Byte %s is not part of a command" % index)
+        packet = self.packet
+        # Checksum16 is the sum of bytes 6 onwards
+        total = packet[4] + (packet[5] << 8) - packet[index] + value
+        packet[index] = value
+        packet[4] = total & 0xff
+        packet[5] = (total >> 8) & 0xff
+        # Checksum8 covers bytes 1-5
+        total = sum(packet[1:6])
+        total = (total & 0xff) + ((total >> 8) & 0xff)
+        packet[0] = (total & 0xff) + ((total >> 8) & 0xff)
+
+    def send(self):
+        """Sends the packet and returns the results, as getFeedback does."""
+        rcvBuffer = self.device._writeReadPrepared(self)
+        self.device._checkFeedbackResponse(rcvBuffer, self.commandlist)
+        return self.device._buildFeedbackResults(rcvBuffer, self.commandlist, [], 9)
+
+    def __repr__(self):
+        return "<u3.PreparedFeedback( %s )>" % (self.commandlist,)
+
 class FeedbackCommand(object):
     """
     The FeedbackCommand class is the base for all the Feedback commands.